@@ -1,7 +1,13 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, Response, abort
-import os, uuid, sqlite3, random
-from datetime import datetime, timedelta
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, Response, abort, has_request_context, make_response
+from werkzeug.middleware.proxy_fix import ProxyFix
+import os, re, glob, uuid, sqlite3, random, fcntl
+import json, zlib, threading, time, math, hashlib
+from collections import deque
+from functools import wraps
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, timedelta, timezone
 import csv, io, zipfile
+import backup
 
 # -------------------------
 # App setup
@@ -17,8 +23,13 @@ app = Flask(
 # ✅ 生产环境建议用环境变量（Railway Variables 里设置 SECRET_KEY）
 app.secret_key = os.environ.get("SECRET_KEY", "dev")
 
-print("=== TEMPLATE FOLDER ===")
-print(app.template_folder)
+# 前面有几层反向代理（Railway 等平台是 1）：只信这么多层追加的 X-Forwarded-For，request.remote_addr 就是客户端地址
+# 默认 0 = 直连，完全不看 X-Forwarded-For（否则客户端改这个头就能换一个限流桶）
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# import 时只定义东西、不碰数据库；建表检查、模板预编译等一次性工作在 create_app() 里（见文件末尾）
 
 # -------------------------
 # Experiment constants
@@ -34,22 +45,427 @@ T2_DELAY_DAYS = int(os.environ.get("T2_DELAY_DAYS", "0"))
 # -------------------------
 DB_PATH = os.environ.get("DB_PATH", "/data/experiment.db")
 
-def db_conn():
+# 分批/分班（cohort）分库：每个 cohort 一个独立 SQLite 文件，互不争写锁
+#   /consent?cohort=2025A  → {COHORT_DIR}/cohort_2025A.db
+#   不带 cohort 的参与者仍然写 DB_PATH（default）
+#   新分库只由 /consent 建，且名字必须在 COHORTS 白名单里（逗号分隔）；
+#   其它地方给的 cohort 必须已经有库文件，否则 400（不能让任意请求在磁盘上造出新库）
+COHORT_DIR = os.environ.get("COHORT_DIR", "").strip() or os.path.dirname(DB_PATH)
+COHORT_RE = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+COHORT_ALL = "all"          # 仅导出用：合并所有分库
+COHORT_DEFAULT = "default"  # 导出时 default 库的标签
+
+# 已建表的库文件（每个进程每个文件只跑一次 DDL）
+_SCHEMA_READY = set()
+
+# participant_id → cohort（进程内缓存，来源是 default 库的 cohort_registry）
+_PID_COHORT_CACHE = {}
+_PID_COHORT_CACHE_MAX = 50000
+
+
+def normalize_cohort(value) -> str:
+    c = (value or "").strip()
+    if not c or c in (COHORT_ALL, COHORT_DEFAULT):
+        return ""
+    return c if COHORT_RE.match(c) else ""
+
+
+COHORTS = {
+    c.strip() for c in os.environ.get("COHORTS", "").split(",")
+    if normalize_cohort(c)
+}
+
+# 已确认存在的 cohort（只缓存"存在"，分库不会被删）
+_KNOWN_COHORTS = set()
+
+
+class UnknownCohort(LookupError):
+    """请求里的 cohort 没有对应的分库（也不允许在这里新建）"""
+
+
+def cohort_exists(cohort: str) -> bool:
+    if not cohort or cohort in _KNOWN_COHORTS:
+        return True
+    if STORAGE.has_cohort(cohort):
+        _KNOWN_COHORTS.add(cohort)
+        return True
+    return False
+
+
+def cohort_db_path(cohort: str) -> str:
+    if not cohort:
+        return DB_PATH
+    return os.path.join(COHORT_DIR, f"cohort_{cohort}.db")
+
+
+def list_cohorts():
+    """default 库 + 磁盘上已有的 cohort 分库（按名字排序）"""
+    names = []
+    for path in glob.glob(os.path.join(COHORT_DIR, "cohort_*.db")):
+        name = os.path.basename(path)[len("cohort_"):-len(".db")]
+        if normalize_cohort(name):
+            names.append(name)
+    return [""] + sorted(names)
+
+
+# 存储格式（只对新建的库文件生效，每个库自己的格式记在 meta 表里）：
+#   text    ：原样存（默认）
+#   compact ：chat_log 的 role 存 0/1、ts 存 UTC 微秒整数（导出时还原成和 text 库一样的 isoformat()）；material_choice 的 UA 字典化到 user_agents
+#             CHAT_COMPRESS_MIN_BYTES > 0 时，超过这个长度的对话文本用 zlib 压缩成 BLOB
+# 导出 / 归档都按逻辑格式（和 text 一样的列和值）读出，使用方不用关心
+# 代价：compact 的全表导出要在 Python 里逐行解码，比 text 慢（10 万人合成库约慢 20%）；换来更小的库文件 / 备份 / 索引扫描
+STORAGE_FORMAT = os.environ.get("STORAGE_FORMAT", "text").strip().lower()
+STORAGE_FORMATS = ("text", "compact")
+CHAT_COMPRESS_MIN_BYTES = int(os.environ.get("CHAT_COMPRESS_MIN_BYTES", "0"))
+
+ROLE_CODES = {"user": 0, "assistant": 1}
+ROLE_NAMES = ("user", "assistant")
+
+# 库文件路径 → 存储格式（init_db 时确定）
+_STORAGE_FORMAT_BY_PATH = {}
+
+
+# 持续增量备份（见 backup.py）：设置了 BACKUP_DIR 才启用
+#   BACKUP_INTERVAL_SEC       ：多久复制一次新提交的 WAL 帧（= 最多丢多少秒的数据）
+#   BACKUP_SNAPSHOT_SEC       ：多久开一个新代（整库快照），旧代保留 BACKUP_KEEP_GENERATIONS 个
+#   BACKUP_WAL_AUTOCHECKPOINT ：请求连接的 wal_autocheckpoint（页），只是复制线程挂掉时的安全阀
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "").strip()
+BACKUP_INTERVAL_SEC = float(os.environ.get("BACKUP_INTERVAL_SEC", "10"))
+BACKUP_SNAPSHOT_SEC = float(os.environ.get("BACKUP_SNAPSHOT_SEC", "3600"))
+BACKUP_KEEP_GENERATIONS = int(os.environ.get("BACKUP_KEEP_GENERATIONS", "24"))
+BACKUP_WAL_AUTOCHECKPOINT = int(os.environ.get("BACKUP_WAL_AUTOCHECKPOINT", "20000"))
+
+
+class DBConnection(sqlite3.Connection):
+    storage_format = "text"
+
+
+_EPOCH = datetime(1970, 1, 1)
+_US = timedelta(microseconds=1)
+# decode_compact_chat_rows 用：一天里每分钟的 "THH:MM:"
+_CLOCK_MINUTES = [f"T{h:02d}:{m:02d}:" for h in range(24) for m in range(60)]
+
+
+def iso_to_us(dt: datetime) -> int:
+    return (dt - _EPOCH) // _US
+
+
+def encode_chat_text(text: str):
+    if CHAT_COMPRESS_MIN_BYTES > 0:
+        raw = text.encode("utf-8")
+        if len(raw) >= CHAT_COMPRESS_MIN_BYTES:
+            packed = zlib.compress(raw)
+            if len(packed) < len(raw):
+                return packed
+    return text
+
+
+def decode_chat_text(value):
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    return value
+
+
+def _set_storage_format(conn, fmt: str):
+    conn.storage_format = fmt
+
+
+def _open_db(path: str):
     # ✅ 确保目录存在（没挂载 volume 时至少不崩）
-    db_dir = os.path.dirname(DB_PATH)
+    db_dir = os.path.dirname(path)
     if db_dir:
         os.makedirs(db_dir, exist_ok=True)
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(path, factory=DBConnection)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON;")
+    if BACKUP_DIR:
+        # checkpoint 交给复制线程做；这里只留一个很大的安全阀，防止复制线程挂了 WAL 无限长
+        conn.execute(f"PRAGMA wal_autocheckpoint = {int(BACKUP_WAL_AUTOCHECKPOINT)};")
+    _set_storage_format(conn, _STORAGE_FORMAT_BY_PATH.get(path, "text"))
+    return conn
+
+
+def lookup_pid_cohort(pid: str):
+    """登记的 cohort（default 是 ""）；查不到这个 pid 返回 None"""
+    if not pid:
+        return None
+    if pid in _PID_COHORT_CACHE:
+        return _PID_COHORT_CACHE[pid]
+
+    cohort = STORAGE.lookup_cohort(pid)
+    if cohort is None:
+        return None
+    cohort = normalize_cohort(cohort)
+    if len(_PID_COHORT_CACHE) >= _PID_COHORT_CACHE_MAX:
+        _PID_COHORT_CACHE.clear()
+    _PID_COHORT_CACHE[pid] = cohort
+    return cohort
+
+
+def register_pid_cohort(pid: str, cohort: str):
+    if not cohort:
+        return
+    STORAGE.register_cohort(pid, cohort, datetime.utcnow().isoformat())
+    _PID_COHORT_CACHE[pid] = cohort
+
+
+def current_cohort() -> str:
+    """
+    当前请求属于哪个 cohort：
+      1) 请求里带了 pid（URL / JSON）且查得到登记 → 用登记的 cohort（session / URL 上的 cohort 可能是
+         同一台机器上一个参与者留下的，实验室 / 机房共用电脑很常见，不能让它把这个 pid 的数据写进别的库）
+      2) URL ?cohort=（必须是已有的分库，否则 UnknownCohort → 400）
+      3) session 里的 participant_id 的登记（T2 可能隔 7 天、session 已失效时靠 1) 找回）
+      4) session 里的 cohort
+    """
+    if not has_request_context():
+        return ""
+
+    pid = (request.args.get("pid") or "").strip()
+    if not pid and request.is_json:
+        data = request.get_json(silent=True) or {}
+        if isinstance(data, dict):
+            pid = str(data.get("participant_id") or "").strip()
+    c = lookup_pid_cohort(pid)
+    if c is not None:
+        return c
+
+    c = normalize_cohort(request.args.get("cohort"))
+    if c:
+        if not cohort_exists(c):
+            raise UnknownCohort(c)
+        return c
+
+    c = lookup_pid_cohort((session.get("participant_id") or "").strip())
+    if c is not None:
+        return c
+    return normalize_cohort(session.get("cohort"))
+
+
+def db_conn(cohort=None):
+    # cohort=None：跟随当前请求；"" 表示 default 库
+    if cohort is None:
+        cohort = current_cohort()
+    path = cohort_db_path(cohort)
+    if path not in _SCHEMA_READY:
+        if cohort and not os.path.exists(path):
+            # 新分库只能由 STORAGE.create_cohort 建（/consent 校验过白名单之后）
+            raise UnknownCohort(cohort)
+        init_db(cohort)
+    return _open_db(path)
+
+
+# 旁路小库（限流状态、实时事件等）：和实验库分开，WAL + synchronous=OFF，丢了也无所谓
+_SIDECAR_LOCAL = threading.local()
+
+
+def sidecar_conn(path: str, schema: str):
+    # 每个进程 / 线程每个文件一条长连接（fork 之后按 pid 重新打开）
+    if getattr(_SIDECAR_LOCAL, "pid", None) != os.getpid():
+        _SIDECAR_LOCAL.conns = {}
+        _SIDECAR_LOCAL.pid = os.getpid()
+
+    conn = _SIDECAR_LOCAL.conns.get(path)
+    if conn is not None:
+        return conn
+
+    db_dir = os.path.dirname(path)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=1.0, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = OFF;")
+    conn.executescript(schema)
+    _SIDECAR_LOCAL.conns[path] = conn
     return conn
 
 
-def init_db():
-    conn = db_conn()
+def table_columns(cur, table_name: str):
+    return [r[1] for r in cur.execute(f"PRAGMA table_info({table_name});").fetchall()]
+
+
+# (表名, 列, 占位符) → upsert 语句；每种组合只拼一次（每次提交都会用到）
+_UPSERT_SQL_CACHE = {}
+
+
+def upsert_sql(table_name: str, cols, ph: str = "?") -> str:
+    """按 participant_id 覆盖写一行（SQLite 和 PostgreSQL 都认 ON CONFLICT … excluded）"""
+    key = (table_name, tuple(cols), ph)
+    sql = _UPSERT_SQL_CACHE.get(key)
+    if sql is None:
+        updates = [c for c in cols if c != "participant_id"]
+        sql = (
+            f"INSERT INTO {table_name}({', '.join(cols)}) "
+            f"VALUES ({', '.join([ph] * len(cols))}) "
+            f"ON CONFLICT(participant_id) DO UPDATE SET "
+            + ", ".join(f"{c}=excluded.{c}" for c in updates)
+        )
+        _UPSERT_SQL_CACHE[key] = sql
+    return sql
+
+
+def compute_t2_eligible_at(t1_created_at: datetime) -> datetime:
+    return t1_created_at + timedelta(days=T2_DELAY_DAYS)
+
+
+def backfill_t2_eligible_at(cur):
+    rows = cur.execute(
+        "SELECT participant_id, created_at FROM survey_t1 WHERE eligible_at IS NULL"
+    ).fetchall()
+    updates = []
+    for r in rows:
+        try:
+            updates.append((compute_t2_eligible_at(datetime.fromisoformat(r["created_at"])).isoformat(), r["participant_id"]))
+        except Exception:
+            continue
+    cur.executemany("UPDATE survey_t1 SET eligible_at=? WHERE participant_id=?", updates)
+
+
+# -------------------------
+# Survey instruments（声明式问卷定义）
+#   每份问卷只在这里写一次：表单字段名 → 列名 → 量表范围。
+#   建表 DDL、upsert SQL、表单解析都在启动时从定义生成；加 T3 / 新量表只要在 INSTRUMENTS 里加一项。
+# -------------------------
+class SurveyInstrument:
+    def __init__(self, name, table, items, template, done_template,
+                 scale=(1, 7), extra_columns=(), indexes=(), gate=None, locked_template=None):
+        """
+        items:         [(表单字段名, 列名), ...]，全部是 INTEGER 量表题
+        extra_columns: [(列名, 类型, fn(now) -> 值), ...]，提交时由服务端计算（如 eligible_at）
+        gate:          fn(pid) -> (ok, eligible_at_iso, reason)；None 表示随时可填
+        """
+        self.name = name
+        self.table = table
+        self.items = list(items)
+        self.template = template
+        self.done_template = done_template
+        self.locked_template = locked_template
+        self.extra_columns = list(extra_columns)
+        self.indexes = list(indexes)
+        self.gate = gate
+
+        lo, hi = scale
+        # 表单值 → int 的查表：只接受量表范围内的值，其余都记 None
+        self._valid = {str(v): v for v in range(lo, hi + 1)}
+        self._fields = [f for f, _ in self.items]
+
+        self.columns = [c for _, c in self.items]
+        all_cols = self.columns + ["created_at"] + [c for c, _, _ in self.extra_columns]
+
+        col_defs = ",\n".join(
+            [f"        {c} INTEGER" for c in self.columns]
+            + ["        created_at TEXT NOT NULL"]
+            + [f"        {c} {decl}" for c, decl, _ in self.extra_columns]
+        )
+        self.ddl = (
+            f"CREATE TABLE IF NOT EXISTS {table} (\n"
+            f"        participant_id TEXT PRIMARY KEY,\n"
+            f"{col_defs},\n"
+            f"        FOREIGN KEY(participant_id) REFERENCES participants(participant_id)\n"
+            f"    );"
+        )
+        # parse() 返回的参数顺序
+        self.upsert_columns = ["participant_id"] + all_cols
+        self.upsert_sql = upsert_sql(table, self.upsert_columns)
+
+    def parse(self, form, pid: str, now: datetime):
+        """表单 → 一整行参数（一次遍历），顺序同 upsert_columns"""
+        valid = self._valid
+        values = [valid.get((form.get(f) or "").strip()) for f in self._fields]
+        return (pid, *values, now.isoformat(), *[fn(now) for _, _, fn in self.extra_columns])
+
+    def ensure_table(self, cur):
+        """建表；老库缺的列（新加的题目 / 服务端列）用 ALTER 补上；返回新补的列名"""
+        cur.execute(self.ddl)
+        have = set(table_columns(cur, self.table))
+        added = []
+        for c in self.columns:
+            if c not in have:
+                cur.execute(f"ALTER TABLE {self.table} ADD COLUMN {c} INTEGER;")
+                added.append(c)
+        for c, decl, _ in self.extra_columns:
+            if c not in have:
+                cur.execute(f"ALTER TABLE {self.table} ADD COLUMN {c} {decl};")
+                added.append(c)
+        for c in self.indexes:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_{c} ON {self.table}({c});")
+        return added
+
+
+INSTRUMENTS = {}
+
+
+def register_instrument(inst: SurveyInstrument):
+    INSTRUMENTS[inst.name] = inst
+    return inst
+
+
+register_instrument(SurveyInstrument(
+    name="t1",
+    table="survey_t1",
+    items=[
+        ("ti1", "triggered_interest_1"), ("ti2", "triggered_interest_2"), ("ti3", "triggered_interest_3"),
+        ("s1", "support_1"), ("s2", "support_2"), ("s3", "support_3"), ("s4", "support_4"),
+        ("c1", "clarity_1"), ("c2", "clarity_2"), ("c3", "clarity_3"), ("c4", "clarity_4"),
+        ("task1", "task_1"), ("task2", "task_2"), ("task3", "task_3"),
+        ("aff1", "affect_1"), ("aff2", "affect_2"), ("aff3", "affect_3"),
+        ("mplan", "manip_plan"), ("mfb", "manip_feedback"),
+    ],
+    # T2 开放时间在提交 T1 时算好存下来
+    extra_columns=[("eligible_at", "TEXT", lambda now: compute_t2_eligible_at(now).isoformat())],
+    indexes=["eligible_at"],
+    template="survey_t1.html",
+    done_template="done_t1.html",
+))
+
+register_instrument(SurveyInstrument(
+    name="t2",
+    table="survey_t2",
+    items=[
+        ("mi1", "maintained_interest_1"), ("mi2", "maintained_interest_2"), ("mi3", "maintained_interest_3"),
+        ("s1", "support_1"), ("s2", "support_2"), ("s3", "support_3"),
+        ("c1", "clarity_1"), ("c2", "clarity_2"), ("c3", "clarity_3"),
+        ("cont1", "cont_intent_1"),
+    ],
+    gate=lambda pid: get_t2_eligibility(pid),
+    template="t2.html",
+    done_template="done_t2.html",
+    locked_template="t2_locked.html",
+))
+
+
+def init_db(cohort: str = ""):
+    path = cohort_db_path(cohort)
+    conn = _open_db(path)
     cur = conn.cursor()
 
+    # 新库用 INCREMENTAL auto_vacuum（老库需要一次 VACUUM 才会切换，见 archive job）
+    cur.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    if BACKUP_DIR or LIVE_FEED_ENABLED:
+        # WAL 模式（持久设置，写在库文件里）：持续备份靠复制 WAL 帧；
+        # 实时看板拍 snapshot 时要钉住读事务数计数，rollback journal 下读事务会挡住写提交
+        cur.execute("PRAGMA journal_mode = WAL;")
+
+    # 0) meta：记录本库的存储格式；老库（已经有 chat_log）一律视为 text
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS meta (
+        key   TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    """)
+    row = cur.execute("SELECT value FROM meta WHERE key='storage_format'").fetchone()
+    if row:
+        fmt = row["value"]
+    else:
+        is_new = not table_columns(cur, "chat_log")
+        fmt = STORAGE_FORMAT if (is_new and STORAGE_FORMAT in STORAGE_FORMATS) else "text"
+        cur.execute("INSERT INTO meta(key, value) VALUES ('storage_format', ?)", (fmt,))
+    _STORAGE_FORMAT_BY_PATH[path] = fmt
+    _set_storage_format(conn, fmt)
+    compact = (fmt == "compact")
+
     # 1) participants
     cur.execute("""
     CREATE TABLE IF NOT EXISTS participants (
@@ -74,8 +490,15 @@ def init_db():
     """)
     cur.execute("CREATE INDEX IF NOT EXISTS idx_baseline_pid ON baseline(participant_id);")
 
-    # 3) material_choice
-    cur.execute("""
+    # 3) material_choice（compact：user_agent → user_agents 字典表的 ua_id）
+    if compact:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_agents (
+            id INTEGER PRIMARY KEY,
+            ua TEXT NOT NULL UNIQUE
+        );
+        """)
+    cur.execute(f"""
     CREATE TABLE IF NOT EXISTS material_choice (
         id              INTEGER PRIMARY KEY AUTOINCREMENT,
         participant_id   TEXT NOT NULL UNIQUE,
@@ -84,7 +507,7 @@ def init_db():
         page_time        TEXT,
         choice_time      TEXT NOT NULL,
         rt_ms            INTEGER,
-        user_agent       TEXT,
+        {"ua_id INTEGER REFERENCES user_agents(id)" if compact else "user_agent       TEXT"},
         FOREIGN KEY(participant_id) REFERENCES participants(participant_id)
     );
     """)
@@ -116,59 +539,868 @@ def init_db():
     );
     """)
 
-    # 6) chat_log
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS chat_log (
-        id             INTEGER PRIMARY KEY AUTOINCREMENT,
-        participant_id TEXT NOT NULL,
-        turn_id        INTEGER NOT NULL,
-        role           TEXT NOT NULL CHECK(role IN ('user','assistant')),
-        text           TEXT NOT NULL,
-        ts             TEXT NOT NULL,
-        FOREIGN KEY(participant_id) REFERENCES participants(participant_id)
-    );
-    """)
+    # 6) chat_log（compact：role 0=user 1=assistant，ts 为 UTC 微秒；text 可能是 zlib BLOB）
+    if compact:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS chat_log (
+            id             INTEGER PRIMARY KEY AUTOINCREMENT,
+            participant_id TEXT NOT NULL,
+            turn_id        INTEGER NOT NULL,
+            role           INTEGER NOT NULL CHECK(role IN (0,1)),
+            text           TEXT NOT NULL,
+            ts             INTEGER NOT NULL,
+            FOREIGN KEY(participant_id) REFERENCES participants(participant_id)
+        );
+        """)
+    else:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS chat_log (
+            id             INTEGER PRIMARY KEY AUTOINCREMENT,
+            participant_id TEXT NOT NULL,
+            turn_id        INTEGER NOT NULL,
+            role           TEXT NOT NULL CHECK(role IN ('user','assistant')),
+            text           TEXT NOT NULL,
+            ts             TEXT NOT NULL,
+            FOREIGN KEY(participant_id) REFERENCES participants(participant_id)
+        );
+        """)
     cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_pid_turn ON chat_log(participant_id, turn_id);")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_pid_role ON chat_log(participant_id, role);")
 
-    # 7) survey_t1
+    # 7) 8) survey_t1 / survey_t2 …：由 INSTRUMENTS 生成
+    for inst in INSTRUMENTS.values():
+        added = inst.ensure_table(cur)
+        # 老库补了 eligible_at：按 created_at 回填
+        if inst.name == "t1" and "eligible_at" in added:
+            backfill_t2_eligible_at(cur)
+
+    # 9) cohort_registry（只在 default 库里用：pid → cohort 分库）
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS survey_t1 (
+    CREATE TABLE IF NOT EXISTS cohort_registry (
         participant_id TEXT PRIMARY KEY,
-
-        triggered_interest_1 INTEGER, triggered_interest_2 INTEGER, triggered_interest_3 INTEGER,
-        support_1 INTEGER, support_2 INTEGER, support_3 INTEGER, support_4 INTEGER,
-        clarity_1 INTEGER, clarity_2 INTEGER, clarity_3 INTEGER, clarity_4 INTEGER,
-        task_1 INTEGER, task_2 INTEGER, task_3 INTEGER,
-        affect_1 INTEGER, affect_2 INTEGER, affect_3 INTEGER,
-        manip_plan INTEGER, manip_feedback INTEGER,
-
-        created_at TEXT NOT NULL,
-        FOREIGN KEY(participant_id) REFERENCES participants(participant_id)
+        cohort         TEXT NOT NULL,
+        created_at     TEXT NOT NULL
     );
     """)
 
-    # 8) survey_t2
+    # 10) chat_archive：已完成 T2 的参与者，chat_log 压缩成一行（zlib + JSON）
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS survey_t2 (
+    CREATE TABLE IF NOT EXISTS chat_archive (
         participant_id TEXT PRIMARY KEY,
-
-        maintained_interest_1 INTEGER, maintained_interest_2 INTEGER, maintained_interest_3 INTEGER,
-        support_1 INTEGER, support_2 INTEGER, support_3 INTEGER,
-        clarity_1 INTEGER, clarity_2 INTEGER, clarity_3 INTEGER,
-        cont_intent_1 INTEGER,
-
-        created_at TEXT NOT NULL,
+        n_rows         INTEGER NOT NULL,
+        n_user_turns   INTEGER NOT NULL,
+        payload        BLOB NOT NULL,
+        archived_at    TEXT NOT NULL,
         FOREIGN KEY(participant_id) REFERENCES participants(participant_id)
     );
     """)
 
+    # 11) client_events：前端过程数据（只追加；不加外键和二级索引，批量写入尽量便宜）
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS client_events (
+        id             INTEGER PRIMARY KEY AUTOINCREMENT,
+        participant_id TEXT NOT NULL,
+        event_type     TEXT NOT NULL,
+        page           TEXT,
+        client_ts      INTEGER,
+        data           TEXT,
+        received_at    TEXT NOT NULL
+    );
+    """)
+
     conn.commit()
     conn.close()
+    _SCHEMA_READY.add(path)
+
+
+
+# -------------------------
+# 存储格式编解码（text / compact 两种库共用的读写入口）
+# -------------------------
+CHAT_INSERT_SQL = "INSERT INTO chat_log(participant_id, turn_id, role, text, ts) VALUES (?, ?, ?, ?, ?)"
+CLIENT_EVENTS_INSERT_SQL = (
+    "INSERT INTO client_events(participant_id, event_type, page, client_ts, data, received_at) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+
+def chat_role_value(fmt: str, role: str):
+    return ROLE_CODES[role] if fmt == "compact" else role
+
+
+def chat_row_params(fmt: str, pid: str, turn_id: int, role: str, text: str, ts: datetime):
+    if fmt == "compact":
+        return (pid, turn_id, ROLE_CODES[role], encode_chat_text(text), iso_to_us(ts))
+    return (pid, turn_id, role, text, ts.isoformat())
+
+
+def decode_compact_chat_rows(rows):
+    """
+    compact 库 chat_log 的 (id, participant_id, turn_id, role, text, ts) → text 格式的 list，ts 和 isoformat() 逐字一致。
+    导出大表时逐行执行，所以不逐行构造 datetime：日期按天、"THH:MM:" 查表拼出前缀，
+    同一轮一问一答 ts 相同就整个复用
+    """
+    out = []
+    last_us = last_iso = last_day = date = None
+    for id_, pid, turn_id, role, text, us in rows:
+        if us != last_us:
+            last_us = us
+            minute, rest = divmod(us, 60000000)
+            day, minute = divmod(minute, 1440)
+            if day != last_day:
+                last_day, date = day, (_EPOCH + timedelta(days=day)).date().isoformat()
+            second, frac = divmod(rest, 1000000)
+            if frac:
+                last_iso = "%s%s%02d.%06d" % (date, _CLOCK_MINUTES[minute], second, frac)
+            else:
+                last_iso = "%s%s%02d" % (date, _CLOCK_MINUTES[minute], second)
+        if text.__class__ is bytes:
+            text = decode_chat_text(text)
+        out.append([id_, pid, turn_id, ROLE_NAMES[role], text, last_iso])
+    return out
+
+
+def logical_select(conn, table_name: str) -> str:
+    """
+    按 text 格式的列名读表；读出的行再过一遍 logical_rows 才是 text 格式的值。
+    compact 库的 material_choice 在 SQL 里 join 回 UA；chat_log 原样读出，在 logical_rows 里解码
+    （SQL 的 strftime 只到毫秒，而且比在 Python 里拼字符串还慢）
+    """
+    if conn.storage_format == "compact":
+        if table_name == "chat_log":
+            return "SELECT id, participant_id, turn_id, role, text, ts FROM chat_log"
+        if table_name == "material_choice":
+            return """
+              SELECT m.id, m.participant_id, m.chosen_direction, m.chosen_label,
+                     m.page_time, m.choice_time, m.rt_ms, u.ua AS user_agent
+              FROM material_choice m LEFT JOIN user_agents u ON u.id = m.ua_id
+            """
+    return f"SELECT * FROM {table_name}"
+
+
+def logical_rows(conn, table_name: str, rows):
+    """logical_select 读出的一批行 → text 格式的 list"""
+    if conn.storage_format == "compact" and table_name == "chat_log":
+        return decode_compact_chat_rows(rows)
+    return [list(r) for r in rows]
+
+
+# (库文件, UA) → ua_id；UA 种类很少，进程内缓存住
+_UA_ID_CACHE = {}
+
+
+def user_agent_id(conn, ua: str):
+    """
+    在 conn 当前的写事务里取 / 建 ua_id。
+    只缓存事务开始前就已提交的 id：本事务刚插入的那行可能跟着回滚，缓存了会让之后的写全部撞外键
+    """
+    if not ua:
+        return None
+    path = conn.execute("PRAGMA database_list;").fetchone()["file"]
+    key = (path, ua)
+    if key in _UA_ID_CACHE:
+        return _UA_ID_CACHE[key]
+
+    inserted = conn.execute("INSERT OR IGNORE INTO user_agents(ua) VALUES (?)", (ua,)).rowcount
+    ua_id = conn.execute("SELECT id FROM user_agents WHERE ua=?", (ua,)).fetchone()["id"]
+    if not inserted:
+        if len(_UA_ID_CACHE) > 10000:
+            _UA_ID_CACHE.clear()
+        _UA_ID_CACHE[key] = ua_id
+    return ua_id
+
+
+# -------------------------
+# Storage backends
+#   路由只调用 STORAGE 的方法，不直接写 SQL：
+#     sqlite   ：默认。每个 cohort 一个库文件（上面 db_conn / init_db 那一套），单机、单写者
+#     postgres ：多个实例共用一个库（连接池）；cohort 是每张表上的一列，配额分配用 advisory lock 跨节点串行
+#   STORAGE_BACKEND=postgres，或 DATABASE_URL=postgres://… 时启用（需要 pip install "psycopg[binary,pool]"）
+#   归档 / compact 格式 / WAL 备份是 SQLite 文件层面的东西，postgres 下不启用（交给数据库自己的 VACUUM / PITR）
+# -------------------------
+DATABASE_URL = os.environ.get("DATABASE_URL", "").strip()
+STORAGE_BACKEND = (
+    os.environ.get("STORAGE_BACKEND", "").strip().lower()
+    or ("postgres" if DATABASE_URL.startswith(("postgres://", "postgresql://")) else "sqlite")
+)
+PG_POOL_MIN = int(os.environ.get("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.environ.get("PG_POOL_MAX", "10"))
+
+
+def choose_condition_cell(counts):
+    """最少的格子里随机挑一个；返回 ((planning, feedback), 分配后该格人数)"""
+    min_count = min(counts.values())
+    candidate_cells = [cell for cell, c in counts.items() if c == min_count]
+    cell = random.choice(candidate_cells)
+    return cell, counts[cell] + 1
+
+
+class SqliteStorage:
+    name = "sqlite"
+
+    def prepare(self):
+        """所有已有库文件跑一遍建表 / 迁移检查（之后 db_conn 不再重复）；不留打开的连接"""
+        for c in list_cohorts():
+            if cohort_db_path(c) not in _SCHEMA_READY:
+                init_db(c)
+
+    def cohorts(self):
+        return list_cohorts()
+
+    def has_cohort(self, cohort: str) -> bool:
+        return os.path.exists(cohort_db_path(cohort))
+
+    def create_cohort(self, cohort: str):
+        if cohort_db_path(cohort) not in _SCHEMA_READY:
+            init_db(cohort)
+
+    def lookup_cohort(self, pid: str):
+        """登记表里的 cohort；default 参与者不登记，在 default 库的 participants 里就是 ""；都没有返回 None"""
+        conn = db_conn("")
+        try:
+            row = conn.execute(
+                "SELECT cohort FROM cohort_registry WHERE participant_id=?",
+                (pid,)
+            ).fetchone()
+            if row:
+                return row["cohort"]
+            row = conn.execute("SELECT 1 FROM participants WHERE participant_id=?", (pid,)).fetchone()
+            return "" if row else None
+        finally:
+            conn.close()
+
+    def register_cohort(self, pid: str, cohort: str, now: str):
+        conn = db_conn("")
+        try:
+            conn.execute("""
+              INSERT OR REPLACE INTO cohort_registry(participant_id, cohort, created_at)
+              VALUES (?, ?, ?)
+            """, (pid, cohort, now))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def create_participant(self, cohort: str, pid: str, now: str):
+        conn = db_conn(cohort)
+        try:
+            conn.execute("""
+                INSERT INTO participants (participant_id, consent_time, created_at)
+                VALUES (?, ?, ?)
+            """, (pid, now, now))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def ensure_participant(self, cohort: str, pid: str, now: str):
+        conn = db_conn(cohort)
+        try:
+            conn.execute("""
+                INSERT OR IGNORE INTO participants(participant_id, created_at)
+                VALUES (?, ?)
+            """, (pid, now))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
 
+    def assign_condition(self, cohort: str, pid: str, now: str):
+        """返回 (planning, feedback, 新分配时该格人数 / 已有分配时 None)"""
+        conn = db_conn(cohort)
+        cur = conn.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE;")
+            cur.execute("""
+              INSERT OR IGNORE INTO participants(participant_id, created_at)
+              VALUES (?, ?)
+            """, (pid, now))
+
+            row = cur.execute("""
+              SELECT condition_planning, condition_feedback
+              FROM condition_assign
+              WHERE participant_id=?
+            """, (pid,)).fetchone()
+            if row:
+                conn.commit()
+                return row["condition_planning"], row["condition_feedback"], None
+
+            (planning, feedback), cell_count = choose_condition_cell(count_condition_cells(cur))
+            cur.execute("""
+              INSERT INTO condition_assign(participant_id, condition_planning, condition_feedback, assigned_at)
+              VALUES (?, ?, ?, ?)
+            """, (pid, planning, feedback, now))
+            conn.commit()
+            return planning, feedback, cell_count
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def upsert(self, cohort: str, table_name: str, cols, params):
+        conn = db_conn(cohort)
+        try:
+            # compact 库：UA 存字典表 id
+            if table_name == "material_choice" and conn.storage_format == "compact":
+                i = cols.index("user_agent")
+                cols = cols[:i] + ["ua_id"] + cols[i + 1:]
+                params = (*params[:i], user_agent_id(conn, params[i]), *params[i + 1:])
+            conn.execute(upsert_sql(table_name, cols), params)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def has_row(self, cohort: str, table_name: str, pid: str) -> bool:
+        conn = db_conn(cohort)
+        row = conn.execute(
+            f"SELECT 1 FROM {table_name} WHERE participant_id=?",
+            (pid,)
+        ).fetchone()
+        conn.close()
+        return row is not None
+
+    def count_user_turns(self, cohort: str, pid: str) -> int:
+        conn = db_conn(cohort)
+        try:
+            return count_user_turns(conn, pid)
+        finally:
+            conn.close()
+
+    def append_chat_turn(self, cohort: str, pid: str, user_text: str, make_reply, max_turns: int, now: datetime):
+        """
+        计数 + 写入一问一答放在一个写事务里（连点两次不会拿到同一个 turn_id）。
+        返回 (turn_id, assistant_text)；超过 max_turns 返回 (None, None)
+        """
+        conn = db_conn(cohort)
+        cur = conn.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE;")
+            turn_id = count_user_turns(conn, pid) + 1
+            if turn_id > max_turns:
+                conn.rollback()
+                return None, None
+
+            assistant_text = make_reply(turn_id)
+            fmt = conn.storage_format
+            cur.execute(CHAT_INSERT_SQL, chat_row_params(fmt, pid, turn_id, "user", user_text, now))
+            cur.execute(CHAT_INSERT_SQL, chat_row_params(fmt, pid, turn_id, "assistant", assistant_text, now))
+            conn.commit()
+            return turn_id, assistant_text
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def append_client_events(self, cohort: str, rows):
+        """rows: [(participant_id, event_type, page, client_ts, data, received_at), ...]，一次 executemany"""
+        conn = db_conn(cohort)
+        try:
+            conn.executemany(CLIENT_EVENTS_INSERT_SQL, rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def t1_times(self, cohort: str, pid: str):
+        """(created_at, eligible_at) 或 None"""
+        conn = db_conn(cohort)
+        row = conn.execute(
+            "SELECT created_at, eligible_at FROM survey_t1 WHERE participant_id=?",
+            (pid,)
+        ).fetchone()
+        conn.close()
+        return (row["created_at"], row["eligible_at"]) if row else None
+
+    def t2_eligible_between(self, cohort: str, start: str, end: str, pending_only: bool):
+        sql = """
+          SELECT t.participant_id, t.eligible_at
+          FROM survey_t1 t
+          WHERE t.eligible_at >= ? AND t.eligible_at < ?
+        """
+        if pending_only:
+            sql += " AND NOT EXISTS (SELECT 1 FROM survey_t2 s WHERE s.participant_id = t.participant_id)"
+        sql += " ORDER BY t.eligible_at"
+
+        conn = db_conn(cohort)
+        rows = conn.execute(sql, (start, end)).fetchall()
+        conn.close()
+        return [(r["participant_id"], r["eligible_at"]) for r in rows]
+
+    def table_counts(self, cohort: str, tables):
+        conn = db_conn(cohort)
+        q = lambda sql: conn.execute(sql).fetchone()[0]  # noqa: E731
+        counts = {t: q(f"SELECT COUNT(*) FROM {t};") for t in tables}
+        counts["chat_archive"] = q("SELECT COUNT(*) FROM chat_archive;")
+        conn.close()
+        return counts
+
+    def pin_live_counts(self):
+        """
+        每个库开一个读事务钉住此刻的快照（只读一下 schema，很快），返回 finish()：
+        在这些快照里数计数、关连接。调用方只需要在 pin 这一步持锁，慢的 COUNT 放到锁外。
+        """
+        conns = []
+        try:
+            for c in self.cohorts():
+                conn = db_conn(c)
+                conns.append((c, conn))
+                conn.execute("BEGIN;")
+                # 读事务到第一次真正读库文件时才拿快照；SELECT 1 不读库，读 sqlite_master
+                conn.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()
+        except Exception:
+            for _, conn in conns:
+                conn.close()
+            raise
+
+        def finish():
+            try:
+                return {c or COHORT_DEFAULT: self._live_counts(conn) for c, conn in conns}
+            finally:
+                for _, conn in conns:
+                    conn.close()
+        return finish
+
+    def _live_counts(self, conn):
+        cur = conn.cursor()
+        q = lambda sql: cur.execute(sql).fetchone()[0]  # noqa: E731
+        cells = count_condition_cells(cur)
+        return {
+            "participants": q("SELECT COUNT(*) FROM participants;"),
+            "cells": {f"{p}/{f}": n for (p, f), n in cells.items()},
+            "chat_turns": cur.execute(
+                "SELECT COUNT(*) FROM chat_log WHERE role=?;", (chat_role_value(conn.storage_format, "user"),)
+            ).fetchone()[0]
+                          + q("SELECT COALESCE(SUM(n_user_turns), 0) FROM chat_archive;"),
+            "survey_t1": q("SELECT COUNT(*) FROM survey_t1;"),
+            "survey_t2": q("SELECT COUNT(*) FROM survey_t2;"),
+        }
+
+    def iter_table(self, cohort: str, table_name: str):
+        """先 yield 列名，再逐行 yield（逻辑格式）；chat_log 的已归档部分接在后面"""
+        conn = db_conn(cohort)
+        try:
+            cur = conn.cursor()
+            cur.row_factory = None  # 大表逐行读：普通 tuple 比 sqlite3.Row 快得多
+            cur.execute(logical_select(conn, table_name))
+            cols = [d[0] for d in cur.description]
+            yield cols
+
+            while True:
+                rows = cur.fetchmany(2000)
+                if not rows:
+                    break
+                yield from logical_rows(conn, table_name, rows)
+
+            # chat_log：已归档的参与者在这里解压接上，导出方不用关心
+            if table_name == "chat_log":
+                arch = conn.execute("SELECT payload FROM chat_archive ORDER BY participant_id")
+                for a in arch:
+                    a_cols, a_rows = decode_chat_archive(a["payload"])
+                    idx = [a_cols.index(col) for col in cols]
+                    for r in a_rows:
+                        yield [r[i] for i in idx]
+        finally:
+            conn.close()
+
+
+# PostgreSQL 表结构：列和 SQLite 的 text 格式一致（时间仍是 ISO 文本，导出结果两边一样），每张表多一列 cohort
+PG_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS participants (
+        participant_id TEXT PRIMARY KEY,
+        consent_time   TEXT,
+        created_at     TEXT NOT NULL,
+        cohort         TEXT NOT NULL DEFAULT ''
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_participants_cohort ON participants(cohort)",
+    """
+    CREATE TABLE IF NOT EXISTS baseline (
+        id             BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        participant_id TEXT NOT NULL UNIQUE REFERENCES participants(participant_id),
+        grade_major    TEXT NOT NULL,
+        culture_course TEXT,
+        chatbot_exp    TEXT,
+        stress_1w      TEXT,
+        created_at     TEXT NOT NULL,
+        cohort         TEXT NOT NULL DEFAULT ''
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS material_choice (
+        id               BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        participant_id   TEXT NOT NULL UNIQUE REFERENCES participants(participant_id),
+        chosen_direction TEXT NOT NULL,
+        chosen_label     TEXT,
+        page_time        TEXT,
+        choice_time      TEXT NOT NULL,
+        rt_ms            INTEGER,
+        user_agent       TEXT,
+        cohort           TEXT NOT NULL DEFAULT ''
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_material_choice_direction ON material_choice(chosen_direction)",
+    """
+    CREATE TABLE IF NOT EXISTS condition_assign (
+        participant_id      TEXT PRIMARY KEY REFERENCES participants(participant_id),
+        condition_planning  TEXT NOT NULL CHECK(condition_planning IN ('pre','none')),
+        condition_feedback  TEXT NOT NULL CHECK(condition_feedback IN ('focused','generic')),
+        assigned_at         TEXT NOT NULL,
+        cohort              TEXT NOT NULL DEFAULT ''
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_condition_assign_cell ON condition_assign(cohort, condition_planning, condition_feedback)",
+    """
+    CREATE TABLE IF NOT EXISTS planning_input (
+        participant_id          TEXT PRIMARY KEY REFERENCES participants(participant_id),
+        plan_goal               TEXT NOT NULL,
+        plan_audience_context   TEXT NOT NULL,
+        plan_elements           TEXT NOT NULL,
+        plan_output             TEXT NOT NULL,
+        created_at              TEXT NOT NULL,
+        cohort                  TEXT NOT NULL DEFAULT ''
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_log (
+        id             BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        participant_id TEXT NOT NULL REFERENCES participants(participant_id),
+        turn_id        INTEGER NOT NULL,
+        role           TEXT NOT NULL CHECK(role IN ('user','assistant')),
+        text           TEXT NOT NULL,
+        ts             TEXT NOT NULL,
+        cohort         TEXT NOT NULL DEFAULT ''
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_chat_pid_turn ON chat_log(participant_id, turn_id)",
+    "CREATE INDEX IF NOT EXISTS idx_chat_pid_role ON chat_log(participant_id, role)",
+    "CREATE INDEX IF NOT EXISTS idx_chat_cohort_role ON chat_log(cohort, role)",
+    """
+    CREATE TABLE IF NOT EXISTS client_events (
+        id             BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        participant_id TEXT NOT NULL,
+        event_type     TEXT NOT NULL,
+        page           TEXT,
+        client_ts      BIGINT,
+        data           TEXT,
+        received_at    TEXT NOT NULL,
+        cohort         TEXT NOT NULL DEFAULT ''
+    )
+    """,
+]
+
+
+def pg_lock_key(name: str) -> int:
+    """advisory lock 的 bigint key（各节点算出来一样）"""
+    return int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+class PostgresStorage:
+    name = "postgres"
+
+    def __init__(self, dsn: str):
+        try:
+            import psycopg  # noqa: F401
+            from psycopg_pool import ConnectionPool
+        except ImportError:
+            raise RuntimeError('STORAGE_BACKEND=postgres needs psycopg 3: pip install "psycopg[binary,pool]"')
+        if not dsn:
+            raise RuntimeError("STORAGE_BACKEND=postgres needs DATABASE_URL")
+
+        self._pool_cls = ConnectionPool
+        self.dsn = dsn
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        self._schema_ready = False
+        self._export_cols = {}
+
+    def prepare(self):
+        """建表检查用一条临时连接做完就关（master 里不能留连接池：池子有后台线程，fork 不安全）"""
+        if self._schema_ready:
+            return
+        import psycopg
+        with psycopg.connect(self.dsn) as conn:
+            self._init_schema(conn)
+        self._schema_ready = True
+
+    def conn(self):
+        """连接池按进程懒创建（fork 之后第一次用时）；没 prepare 过的话顺便建表"""
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._pool_lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    pool = self._pool_cls(self.dsn, min_size=PG_POOL_MIN, max_size=PG_POOL_MAX, open=True)
+                    if not self._schema_ready:
+                        with pool.connection() as conn:
+                            self._init_schema(conn)
+                        self._schema_ready = True
+                    self._pool, self._pool_pid = pool, os.getpid()
+        # with STORAGE.conn() as conn: … 正常退出提交，异常回滚，连接回池
+        return self._pool.connection()
+
+    def _init_schema(self, conn):
+        # 多个节点同时启动：建表串行做
+        conn.execute("SELECT pg_advisory_xact_lock(%s)", (pg_lock_key("schema"),))
+        for ddl in PG_SCHEMA:
+            conn.execute(ddl)
+
+        for inst in INSTRUMENTS.values():
+            conn.execute(inst.ddl)
+            for c in inst.columns:
+                conn.execute(f"ALTER TABLE {inst.table} ADD COLUMN IF NOT EXISTS {c} INTEGER")
+            for c, decl, _ in inst.extra_columns:
+                conn.execute(f"ALTER TABLE {inst.table} ADD COLUMN IF NOT EXISTS {c} {decl}")
+            conn.execute(f"ALTER TABLE {inst.table} ADD COLUMN IF NOT EXISTS cohort TEXT NOT NULL DEFAULT ''")
+            for c in inst.indexes:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{inst.table}_{c} ON {inst.table}({c})")
+
+        # 同 backfill_t2_eligible_at：老数据补 eligible_at
+        rows = conn.execute("SELECT participant_id, created_at FROM survey_t1 WHERE eligible_at IS NULL").fetchall()
+        updates = []
+        for pid, created_at in rows:
+            try:
+                updates.append((compute_t2_eligible_at(datetime.fromisoformat(created_at)).isoformat(), pid))
+            except Exception:
+                continue
+        if updates:
+            conn.cursor().executemany("UPDATE survey_t1 SET eligible_at=%s WHERE participant_id=%s", updates)
+
+    def cohorts(self):
+        with self.conn() as conn:
+            return self._cohorts(conn)
+
+    def _cohorts(self, conn):
+        rows = conn.execute("SELECT DISTINCT cohort FROM participants ORDER BY cohort").fetchall()
+        names = [r[0] for r in rows if normalize_cohort(r[0])]
+        return [""] + names
+
+    def has_cohort(self, cohort: str) -> bool:
+        with self.conn() as conn:
+            row = conn.execute("SELECT 1 FROM participants WHERE cohort=%s LIMIT 1", (cohort,)).fetchone()
+        return row is not None
+
+    def create_cohort(self, cohort: str):
+        # cohort 只是 participants 上的一列，没有要建的东西
+        pass
+
+    def lookup_cohort(self, pid: str):
+        with self.conn() as conn:
+            row = conn.execute("SELECT cohort FROM participants WHERE participant_id=%s", (pid,)).fetchone()
+        return row[0] if row else None
+
+    def register_cohort(self, pid: str, cohort: str, now: str):
+        # cohort 就存在 participants 上，create_participant 时一起写
+        pass
+
+    def create_participant(self, cohort: str, pid: str, now: str):
+        with self.conn() as conn:
+            conn.execute("""
+                INSERT INTO participants (participant_id, consent_time, created_at, cohort)
+                VALUES (%s, %s, %s, %s)
+            """, (pid, now, now, cohort))
+
+    def ensure_participant(self, cohort: str, pid: str, now: str):
+        with self.conn() as conn:
+            conn.execute("""
+                INSERT INTO participants(participant_id, created_at, cohort)
+                VALUES (%s, %s, %s)
+                ON CONFLICT(participant_id) DO NOTHING
+            """, (pid, now, cohort))
+
+    def assign_condition(self, cohort: str, pid: str, now: str):
+        with self.conn() as conn:
+            conn.execute("""
+              INSERT INTO participants(participant_id, created_at, cohort)
+              VALUES (%s, %s, %s)
+              ON CONFLICT(participant_id) DO NOTHING
+            """, (pid, now, cohort))
+
+            sql_existing = """
+              SELECT condition_planning, condition_feedback
+              FROM condition_assign
+              WHERE participant_id=%s
+            """
+            row = conn.execute(sql_existing, (pid,)).fetchone()
+            if row:
+                return row[0], row[1], None
+
+            # 同一 cohort 的分配在所有节点之间串行：锁到事务结束
+            conn.execute("SELECT pg_advisory_xact_lock(%s)", (pg_lock_key(f"quota:{cohort}"),))
+            row = conn.execute(sql_existing, (pid,)).fetchone()
+            if row:
+                return row[0], row[1], None
+
+            counts = {cell: 0 for cell in CONDITION_CELLS}
+            for p, f, n in conn.execute("""
+              SELECT condition_planning, condition_feedback, COUNT(*)
+              FROM condition_assign
+              WHERE cohort=%s
+              GROUP BY condition_planning, condition_feedback
+            """, (cohort,)):
+                if (p, f) in counts:
+                    counts[(p, f)] = int(n)
+
+            (planning, feedback), cell_count = choose_condition_cell(counts)
+            conn.execute("""
+              INSERT INTO condition_assign(participant_id, condition_planning, condition_feedback, assigned_at, cohort)
+              VALUES (%s, %s, %s, %s, %s)
+            """, (pid, planning, feedback, now, cohort))
+            return planning, feedback, cell_count
+
+    def upsert(self, cohort: str, table_name: str, cols, params):
+        with self.conn() as conn:
+            conn.execute(upsert_sql(table_name, list(cols) + ["cohort"], "%s"), (*params, cohort))
+
+    def has_row(self, cohort: str, table_name: str, pid: str) -> bool:
+        with self.conn() as conn:
+            row = conn.execute(f"SELECT 1 FROM {table_name} WHERE participant_id=%s", (pid,)).fetchone()
+        return row is not None
+
+    def _count_user_turns(self, conn, pid: str) -> int:
+        return int(conn.execute(
+            "SELECT COUNT(*) FROM chat_log WHERE participant_id=%s AND role='user'",
+            (pid,)
+        ).fetchone()[0])
+
+    def count_user_turns(self, cohort: str, pid: str) -> int:
+        with self.conn() as conn:
+            return self._count_user_turns(conn, pid)
+
+    def append_chat_turn(self, cohort: str, pid: str, user_text: str, make_reply, max_turns: int, now: datetime):
+        with self.conn() as conn:
+            # 同一参与者的轮次编号跨节点串行
+            conn.execute("SELECT pg_advisory_xact_lock(%s)", (pg_lock_key(f"chat:{pid}"),))
+            turn_id = self._count_user_turns(conn, pid) + 1
+            if turn_id > max_turns:
+                return None, None
+
+            assistant_text = make_reply(turn_id)
+            ts = now.isoformat()
+            conn.cursor().executemany("""
+              INSERT INTO chat_log(participant_id, turn_id, role, text, ts, cohort)
+              VALUES (%s, %s, %s, %s, %s, %s)
+            """, [
+                (pid, turn_id, "user", user_text, ts, cohort),
+                (pid, turn_id, "assistant", assistant_text, ts, cohort),
+            ])
+            return turn_id, assistant_text
+
+    def append_client_events(self, cohort: str, rows):
+        with self.conn() as conn:
+            conn.cursor().executemany("""
+              INSERT INTO client_events(participant_id, event_type, page, client_ts, data, received_at, cohort)
+              VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, [(*r, cohort) for r in rows])
+
+    def t1_times(self, cohort: str, pid: str):
+        with self.conn() as conn:
+            row = conn.execute(
+                "SELECT created_at, eligible_at FROM survey_t1 WHERE participant_id=%s",
+                (pid,)
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def t2_eligible_between(self, cohort: str, start: str, end: str, pending_only: bool):
+        sql = """
+          SELECT t.participant_id, t.eligible_at
+          FROM survey_t1 t
+          WHERE t.cohort = %s AND t.eligible_at >= %s AND t.eligible_at < %s
+        """
+        if pending_only:
+            sql += " AND NOT EXISTS (SELECT 1 FROM survey_t2 s WHERE s.participant_id = t.participant_id)"
+        sql += " ORDER BY t.eligible_at"
+
+        with self.conn() as conn:
+            return [(r[0], r[1]) for r in conn.execute(sql, (cohort, start, end)).fetchall()]
+
+    def table_counts(self, cohort: str, tables):
+        with self.conn() as conn:
+            return {
+                t: conn.execute(f"SELECT COUNT(*) FROM {t} WHERE cohort=%s", (cohort,)).fetchone()[0]
+                for t in tables
+            }
+
+    def pin_live_counts(self):
+        """一个 REPEATABLE READ 事务，快照在 SELECT 1 时拍下；返回 finish() 在这个快照里数完、还连接"""
+        stack = ExitStack()
+        conn = stack.enter_context(self.conn())
+        try:
+            conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            conn.execute("SELECT 1")
+        except Exception:
+            stack.close()
+            raise
+
+        def finish():
+            with stack:
+                return {c or COHORT_DEFAULT: self._live_counts(conn, c) for c in self._cohorts(conn)}
+        return finish
+
+    def _live_counts(self, conn, cohort: str):
+        q = lambda sql: conn.execute(sql, (cohort,)).fetchone()[0]  # noqa: E731
+        cells = {f"{p}/{f}": 0 for p, f in CONDITION_CELLS}
+        for p, f, n in conn.execute("""
+          SELECT condition_planning, condition_feedback, COUNT(*)
+          FROM condition_assign WHERE cohort=%s
+          GROUP BY condition_planning, condition_feedback
+        """, (cohort,)):
+            cells[f"{p}/{f}"] = int(n)
+        return {
+            "participants": q("SELECT COUNT(*) FROM participants WHERE cohort=%s"),
+            "cells": cells,
+            "chat_turns": q("SELECT COUNT(*) FROM chat_log WHERE cohort=%s AND role='user'"),
+            "survey_t1": q("SELECT COUNT(*) FROM survey_t1 WHERE cohort=%s"),
+            "survey_t2": q("SELECT COUNT(*) FROM survey_t2 WHERE cohort=%s"),
+        }
+
+    def export_columns(self, conn, table_name: str):
+        cols = self._export_cols.get(table_name)
+        if cols is None:
+            cols = [r[0] for r in conn.execute("""
+              SELECT column_name FROM information_schema.columns
+              WHERE table_schema = current_schema() AND table_name = %s
+              ORDER BY ordinal_position
+            """, (table_name,)).fetchall() if r[0] != "cohort"]
+            self._export_cols[table_name] = cols
+        return cols
+
+    def iter_table(self, cohort: str, table_name: str):
+        with self.conn() as conn:
+            cols = self.export_columns(conn, table_name)
+            yield cols
+
+            order = "id" if "id" in cols else "participant_id"
+            # 服务端游标：大表导出时不会一次把结果全拉进内存
+            with conn.cursor(name=f"export_{uuid.uuid4().hex}") as cur:
+                cur.itersize = 2000
+                cur.execute(
+                    f"SELECT {', '.join(cols)} FROM {table_name} WHERE cohort=%s ORDER BY {order}",
+                    (cohort,)
+                )
+                for r in cur:
+                    yield list(r)
+
+
+def make_storage():
+    if STORAGE_BACKEND == "postgres":
+        return PostgresStorage(DATABASE_URL)
+    if STORAGE_BACKEND != "sqlite":
+        raise RuntimeError(f"unknown STORAGE_BACKEND={STORAGE_BACKEND!r} (sqlite / postgres)")
+    return SqliteStorage()
+
+
+STORAGE = make_storage()
 
-# ✅ 只调用一次：在定义后、路由前（Railway gunicorn 启动也会执行这里）
-init_db()
 
 # -------------------------
 # pid helper：URL 优先，其次 session
@@ -180,6 +1412,31 @@ def get_pid_from_request():
     return (session.get("participant_id") or "").strip()
 
 
+# -------------------------
+# cohort 透传：URL 上带了 cohort 就记进 session；url_for 自动带上 cohort
+# -------------------------
+@app.before_request
+def remember_cohort_from_url():
+    c = normalize_cohort(request.args.get("cohort"))
+    if c and session.get("cohort") != c and cohort_exists(c):
+        session["cohort"] = c
+
+
+@app.errorhandler(UnknownCohort)
+def unknown_cohort(e):
+    if request.path.startswith("/api/"):
+        return jsonify({"ok": False, "error": "unknown_cohort"}), 400
+    return "Unknown cohort", 400
+
+
+@app.url_defaults
+def add_cohort_to_urls(endpoint, values):
+    if "pid" in values and "cohort" not in values:
+        c = current_cohort()
+        if c:
+            values["cohort"] = c
+
+
 # -------------------------
 # Export token guard (强制必须设置)
 # -------------------------
@@ -197,124 +1454,437 @@ def require_export_token_or_403():
 
 
 # -------------------------
-# Condition assignment (Quota)
+# Admission control（写接口限流）
+#   - 每个 participant / 每个 IP 一个 token bucket
+#   - 写接口全局并发上限 + 短排队
+#   - 状态放在独立的 SQLite 文件里，gunicorn 多 worker 共享，不和实验库抢锁
 # -------------------------
-def get_or_assign_condition(participant_id: str):
-    conn = db_conn()
-    cur = conn.cursor()
+RATELIMIT_ENABLED = os.environ.get("RATELIMIT_ENABLED", "1") == "1"
+RATELIMIT_DB_PATH = os.environ.get("RATELIMIT_DB_PATH", "").strip() or os.path.join(
+    os.path.dirname(DB_PATH), "ratelimit.db"
+)
+
+# 每秒补充多少 token / 桶容量
+RL_PID_RATE = float(os.environ.get("RL_PID_RATE", "1"))
+RL_PID_BURST = float(os.environ.get("RL_PID_BURST", "5"))
+# 一个班常常共用一个出口 IP，所以 IP 桶要宽松很多
+RL_IP_RATE = float(os.environ.get("RL_IP_RATE", "20"))
+RL_IP_BURST = float(os.environ.get("RL_IP_BURST", "100"))
+
+WRITE_CONCURRENCY = int(os.environ.get("WRITE_CONCURRENCY", "8"))
+WRITE_QUEUE_MS = int(os.environ.get("WRITE_QUEUE_MS", "200"))
+# 进程崩溃没释放的 slot 过期时间
+WRITE_SLOT_TTL_SEC = 30
+
+RATELIMIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rl_bucket (
+    key     TEXT PRIMARY KEY,
+    tokens  REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rl_slot (
+    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    acquired REAL NOT NULL
+);
+"""
+
+
+def _ratelimit_conn():
+    return sidecar_conn(RATELIMIT_DB_PATH, RATELIMIT_SCHEMA)
+
+
+def _take_token(conn, key: str, rate: float, burst: float, now: float) -> float:
+    """消耗一个 token；返回 0 表示放行，否则返回需要等待的秒数"""
+    row = conn.execute("SELECT tokens, updated FROM rl_bucket WHERE key=?", (key,)).fetchone()
+    tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+
+    if tokens >= 1:
+        tokens -= 1
+        wait = 0.0
+    else:
+        wait = (1 - tokens) / rate if rate > 0 else 60.0
+
+    conn.execute("""
+      INSERT INTO rl_bucket(key, tokens, updated) VALUES (?, ?, ?)
+      ON CONFLICT(key) DO UPDATE SET tokens=excluded.tokens, updated=excluded.updated
+    """, (key, tokens, now))
+    return wait
+
+
+def client_ip() -> str:
+    # 代理头只由 ProxyFix 按 TRUSTED_PROXIES 处理，这里不直接读 X-Forwarded-For
+    return request.remote_addr or ""
 
+
+def take_tokens(buckets) -> float:
+    """buckets = [(key, rate, burst), ...]，每个桶各扣一个 token；返回 0 表示放行，否则返回需要等待的秒数"""
+    conn = _ratelimit_conn()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE;")
     try:
-        cur.execute("BEGIN IMMEDIATE;")
+        wait = 0.0
+        for key, rate, burst in buckets:
+            wait = max(wait, _take_token(conn, key, rate, burst, now))
+        # 偶尔清理很久没动过的桶
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM rl_bucket WHERE updated < ?", (now - 3600,))
+        conn.execute("COMMIT;")
+    except Exception:
+        conn.execute("ROLLBACK;")
+        raise
+    return wait
 
-        cur.execute("""
-          INSERT OR IGNORE INTO participants(participant_id, created_at)
-          VALUES (?, datetime('now'))
-        """, (participant_id,))
 
-        row = cur.execute("""
-          SELECT condition_planning, condition_feedback
-          FROM condition_assign
-          WHERE participant_id=?
-        """, (participant_id,)).fetchone()
+def admit_write(pid: str, ip: str):
+    """
+    返回 (slot_id, retry_after)：
+      slot_id 不为 None → 放行，用完调用 release_write(slot_id)
+      否则 retry_after 秒后再试
+    """
+    deadline = time.time() + WRITE_QUEUE_MS / 1000.0
 
-        if row:
-            conn.commit()
-            conn.close()
-            return row["condition_planning"], row["condition_feedback"]
+    buckets = []
+    if pid:
+        buckets.append(("pid:" + pid, RL_PID_RATE, RL_PID_BURST))
+    if ip:
+        buckets.append(("ip:" + ip, RL_IP_RATE, RL_IP_BURST))
+    wait = take_tokens(buckets)
+    if wait > 0:
+        return None, wait
+
+    conn = _ratelimit_conn()
+
+    # 全局并发：拿不到 slot 就在 WRITE_QUEUE_MS 内短暂排队
+    while True:
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            conn.execute("DELETE FROM rl_slot WHERE acquired < ?", (now - WRITE_SLOT_TTL_SEC,))
+            in_use = conn.execute("SELECT COUNT(*) FROM rl_slot").fetchone()[0]
+            slot_id = None
+            if in_use < WRITE_CONCURRENCY:
+                slot_id = conn.execute("INSERT INTO rl_slot(acquired) VALUES (?)", (now,)).lastrowid
+            conn.execute("COMMIT;")
+        except Exception:
+            conn.execute("ROLLBACK;")
+            raise
+
+        if slot_id is not None:
+            return slot_id, 0.0
+        if now >= deadline:
+            return None, 1.0
+        time.sleep(0.01)
+
+
+def release_write(slot_id: int):
+    _ratelimit_conn().execute("DELETE FROM rl_slot WHERE id=?", (slot_id,))
+
+
+def too_many_requests(retry_after: float):
+    retry = str(max(1, int(math.ceil(retry_after))))
+    if request.path.startswith("/api/"):
+        resp = jsonify({"ok": False, "error": "rate_limited", "retry_after": int(retry)})
+        resp.status_code = 429
+    else:
+        resp = Response("Too many requests, please retry shortly", status=429)
+    resp.headers["Retry-After"] = retry
+    return resp
 
-        cells = [
-            ("pre",  "focused"),
-            ("pre",  "generic"),
-            ("none", "focused"),
-            ("none", "generic"),
-        ]
 
-        counts = {}
-        for p, f in cells:
-            c = cur.execute("""
-              SELECT COUNT(*) AS c
-              FROM condition_assign
-              WHERE condition_planning=? AND condition_feedback=?
-            """, (p, f)).fetchone()["c"]
-            counts[(p, f)] = int(c)
+def admission_controlled(view):
+    """写接口装饰器：只对 POST 生效；限流存储出错时放行（不因为限流把实验搞挂）"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not RATELIMIT_ENABLED or request.method != "POST":
+            return view(*args, **kwargs)
 
-        min_count = min(counts.values())
-        candidate_cells = [cell for cell, c in counts.items() if c == min_count]
-        planning, feedback = random.choice(candidate_cells)
+        pid = (request.args.get("pid") or "").strip()
+        if not pid and request.is_json:
+            data = request.get_json(silent=True) or {}
+            if isinstance(data, dict):
+                pid = str(data.get("participant_id") or "").strip()
 
-        cur.execute("""
-          INSERT INTO condition_assign(participant_id, condition_planning, condition_feedback, assigned_at)
-          VALUES (?, ?, ?, datetime('now'))
-        """, (participant_id, planning, feedback))
+        try:
+            slot_id, retry_after = admit_write(pid, client_ip())
+        except sqlite3.Error:
+            import traceback
+            traceback.print_exc()
+            return view(*args, **kwargs)
 
-        conn.commit()
-        conn.close()
-        return planning, feedback
+        if slot_id is None:
+            return too_many_requests(retry_after)
 
-    except Exception:
-        conn.rollback()
-        conn.close()
-        raise
+        try:
+            return view(*args, **kwargs)
+        finally:
+            try:
+                release_write(slot_id)
+            except sqlite3.Error:
+                pass
+
+    return wrapper
 
 
 # -------------------------
-# Assistant reply (rule-based)
+# Live change feed（给研究者看的实时事件流，SSE）
+#   - 写路径只往旁路库 livefeed.db 追加一行（不碰实验库的写锁），所有 worker 共享
+#   - 每个进程一个 tail 线程把新事件读进内存环形缓冲，所有 SSE 连接共用
+#   - 事件 id 就是 live_events.id，断线重连用 Last-Event-ID 续上
+#   - 一致性：写路径在"写实验库 + publish_event"期间持 livefeed.lock 的共享锁，
+#     拍 snapshot 时持排他锁同时取计数和游标 → 不会有事件既算进计数又被推送（或两头都漏）
 # -------------------------
-def generate_assistant_reply(planning_cond: str, feedback_cond: str, user_text: str, turn_id=None) -> str:
-    t = int(turn_id or 1)
-    u = (user_text or "").strip()
+LIVE_FEED_ENABLED = os.environ.get("LIVE_FEED_ENABLED", "1") == "1"
+LIVE_FEED_DB_PATH = os.environ.get("LIVE_FEED_DB_PATH", "").strip() or os.path.join(
+    os.path.dirname(DB_PATH), "livefeed.db"
+)
+LIVE_BUFFER_SIZE = 2000
+LIVE_RETAIN_EVENTS = 20000
+LIVE_POLL_SEC = 0.5
+LIVE_KEEPALIVE_SEC = 15
+# 一条 SSE 连接最长占用多久（到点断开，浏览器自动带 Last-Event-ID 重连）
+LIVE_STREAM_MAX_SEC = int(os.environ.get("LIVE_STREAM_MAX_SEC", "600"))
+
+LIVE_LOCK_PATH = LIVE_FEED_DB_PATH + ".lock"
+
+LIVE_FEED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS live_events (
+    id   INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts   TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+_LIVE_BUFFER = deque(maxlen=LIVE_BUFFER_SIZE)  # (id, ts, kind, data_json)
+_LIVE_COND = threading.Condition()
+_LIVE_TAIL_STARTED = False
+_LIVE_TAIL_PID = None
+
+
+def _live_conn():
+    return sidecar_conn(LIVE_FEED_DB_PATH, LIVE_FEED_SCHEMA)
+
+
+@contextmanager
+def live_lock(mode: int):
+    """livefeed.lock 上的 flock（跨 worker）；锁文件打不开时直接放行"""
+    if not LIVE_FEED_ENABLED:
+        yield
+        return
+    try:
+        fd = os.open(LIVE_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        yield
+        return
+    try:
+        fcntl.flock(fd, mode)
+        yield
+    finally:
+        os.close(fd)
 
-    focused_1_10 = {
-        1: "（聚焦反馈）我们开始吧。我先对齐你的目标：把想法变得更清晰并可推进。\n你想从哪个点切入？（载体 / 文化元素 / 故事氛围 / 符号颜色）",
-        2: "（聚焦反馈）继续说说你的选择：你为什么更偏向这个方向？给我 1–2 个关键词就行。",
-        3: "（聚焦反馈）你想做的成品更像什么？（海报/包装/空间导视/交互界面/短视频封面…）选一个最像的。",
-        4: "（聚焦反馈）你希望面向谁？（同龄人/游客/本地居民/学生/亲子…）给一个目标受众 + 一个使用场景。",
-        5: "（聚焦反馈）选 1 个最核心的文化元素：纹样/器物/工艺/仪式/故事。\n你最想用哪个？（写一个即可）",
-        6: "（聚焦反馈）为它加 2 个形容词：质朴/精致/热烈/神秘/克制/现代/传统… 你选哪两个？",
-        7: "（聚焦反馈）确定视觉锚点：你希望突出“图形符号”还是“故事画面”？二选一。",
-        8: "（聚焦反馈）来一句话概念（15字以内）：用“把___变成___”的句式写一下，我帮你润色。",
-        9: "（聚焦反馈）最后校验风格：你希望整体更“现代极简”还是“传统丰富”？二选一。",
-        10: "（聚焦反馈）总结一下：\n- 载体：{carrier}\n- 受众/场景：{aud}\n- 核心元素：{elem}\n- 气质：{adj}\n- 概念句：{concept}\n\n如果你同意，建议下一步：①列3个参考 ②画2版构图草图。"
-    }
 
-    generic_1_10 = {
-        1: "（通用反馈）我们开始吧。你想先从哪个点说起：载体 / 文化元素 / 故事氛围 / 符号颜色？",
-        2: "（通用反馈）为什么选这个方向？给我 1–2 个关键词就好。",
-        3: "（通用反馈）你想做的成品更像什么？（海报/包装/导视/界面/封面…）",
-        4: "（通用反馈）给一个目标受众 + 一个使用场景。",
-        5: "（通用反馈）选 1 个最核心的文化元素（纹样/器物/工艺/仪式/故事…）。",
-        6: "（通用反馈）再加 2 个形容词（比如热烈/克制/现代/传统…）。",
-        7: "（通用反馈）更想突出“图形符号”还是“故事画面”？",
-        8: "（通用反馈）写一句 15 字以内的概念句（“把___变成___”）。",
-        9: "（通用反馈）更偏“现代极简”还是“传统丰富”？",
-        10: "（通用反馈）我们把要点收一下：载体/受众/元素/气质/概念句。下一步建议做参考收集+草图。"
-    }
+def live_write_section():
+    """包住"写实验库 + publish_event"：snapshot 拍照时不会夹在两者中间"""
+    return live_lock(fcntl.LOCK_SH)
 
-    focused_11_20 = {
-        11: "（反思阶段）我们退一步看整体：你觉得目前概念里最清晰的一点是什么？（一句话）",
-        12: "（反思阶段）那最模糊/最不确定的一点是什么？（一句话）",
-        13: "（反思阶段）如果让它更可落地：你愿意优先改“内容表达”还是“形式呈现”？二选一。",
-        14: "（反思阶段）给它一个明确的核心信息（10–15字）：你希望观众看完记住什么？",
-        15: "（反思阶段）做一次风险检查：最可能被误解的地方是什么？你想怎么避免？",
-        16: "（反思阶段）给 3 个关键词作为设计约束（例如：材质/色彩/符号风格）。你给哪 3 个？",
-        17: "（反思阶段）请列 2 个你想参考的方向（品牌/作品类型/风格流派都行），为什么？",
-        18: "（反思阶段）如果把它做成 A/B 两个版本：A更传统，B更当代。你更想保留哪一点不变？",
-        19: "（反思阶段）自评一下：现在你对这个方案的清晰度从 1–7 你给几分？为什么？",
-        20: "（反思阶段）最后收束：①你下一步最可执行的一件事是什么？②你希望我继续帮你做“润色概念句”还是“拆成制作清单”？"
-    }
 
-    generic_11_20 = {
-        11: "（反思）你觉得现在最清楚的一点是什么？（一句话）",
-        12: "（反思）你觉得最不确定的一点是什么？（一句话）",
-        13: "（反思）想继续完善的话，你更想改内容还是改形式？",
-        14: "（反思）用 10–15 字写一句核心信息：你希望观众记住什么？",
-        15: "（反思）你担心它会被怎么误解？",
-        16: "（反思）给 3 个关键词当作约束（材质/色彩/符号风格）。",
-        17: "（反思）列 2 个你想参考的方向，并说原因。",
-        18: "（反思）如果做 A/B 两版（传统/当代），你更想保留什么不变？",
-        19: "（反思）你对现在方案清晰度 1–7 给几分？为什么？",
-        20: "（反思）最后：你下一步最可执行的一件事是什么？"
-    }
+def publish_event(kind: str, **data):
+    """记录一条实时事件；失败只打印，不影响参与者的请求"""
+    if not LIVE_FEED_ENABLED:
+        return
+    try:
+        now = datetime.utcnow().isoformat()
+        data["ts"] = now
+        conn = _live_conn()
+        cur = conn.execute(
+            "INSERT INTO live_events(ts, kind, data) VALUES (?, ?, ?)",
+            (now, kind, json.dumps(data, ensure_ascii=False))
+        )
+        # 偶尔裁掉太旧的事件
+        if cur.lastrowid % 500 == 0:
+            conn.execute("DELETE FROM live_events WHERE id <= ?", (cur.lastrowid - LIVE_RETAIN_EVENTS,))
+    except sqlite3.Error:
+        import traceback
+        traceback.print_exc()
+
+
+def _live_tail_loop():
+    conn = _live_conn()
+    max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM live_events").fetchone()[0]
+    last_id = max(0, max_id - LIVE_BUFFER_SIZE)
+
+    while True:
+        try:
+            rows = conn.execute(
+                "SELECT id, ts, kind, data FROM live_events WHERE id > ? ORDER BY id LIMIT 1000",
+                (last_id,)
+            ).fetchall()
+        except sqlite3.Error:
+            rows = []
+
+        if rows:
+            with _LIVE_COND:
+                _LIVE_BUFFER.extend(rows)
+                _LIVE_COND.notify_all()
+            last_id = rows[-1][0]
+        else:
+            time.sleep(LIVE_POLL_SEC)
+
+
+def ensure_live_tail():
+    # 第一个 SSE 订阅者出现时才起线程；fork 之后的新进程重新起
+    global _LIVE_TAIL_STARTED, _LIVE_TAIL_PID
+    with _LIVE_COND:
+        if _LIVE_TAIL_STARTED and _LIVE_TAIL_PID == os.getpid():
+            return
+        _LIVE_BUFFER.clear()
+        threading.Thread(target=_live_tail_loop, name="live-tail", daemon=True).start()
+        _LIVE_TAIL_STARTED = True
+        _LIVE_TAIL_PID = os.getpid()
+
+
+def live_events_after(last_id: int, timeout: float):
+    """
+    取 last_id 之后的事件（没有就最多等 timeout 秒）。
+    返回 None 表示环形缓冲已经越过了 last_id（这条连接推得太慢，中间的事件被挤掉了）。
+    """
+    with _LIVE_COND:
+        if not (_LIVE_BUFFER and _LIVE_BUFFER[-1][0] > last_id):
+            _LIVE_COND.wait(timeout)
+        if _LIVE_BUFFER and _LIVE_BUFFER[0][0] > last_id + 1:
+            return None
+        return [e for e in _LIVE_BUFFER if e[0] > last_id]
+
+
+def live_replay(last_id: int):
+    """
+    断线重连：从 live_events 补发 last_id 之后的事件。
+    返回 None 表示中间有缺口（事件已被裁掉），调用方改发 snapshot。
+    """
+    conn = _live_conn()
+    oldest = conn.execute("SELECT MIN(id) FROM live_events").fetchone()[0]
+    if oldest is not None and oldest > last_id + 1:
+        return None
+    return conn.execute(
+        "SELECT id, ts, kind, data FROM live_events WHERE id > ? ORDER BY id LIMIT ?",
+        (last_id, LIVE_RETAIN_EVENTS)
+    ).fetchall()
+
+
+def live_snapshot():
+    """
+    (游标, 各 cohort 当前计数)；只在 SSE 建立连接（或续不上）时算一次。
+    排他锁下读游标、给每个库开读事务钉住快照：此刻没有写到一半、还没 publish 的请求，
+    快照里的计数正好对应 id <= 游标的事件。COUNT 本身在放锁之后做，不挡写请求。
+    """
+    with live_lock(fcntl.LOCK_EX):
+        cursor = _live_conn().execute("SELECT COALESCE(MAX(id), 0) FROM live_events").fetchone()[0]
+        finish = STORAGE.pin_live_counts()
+    return cursor, finish()
+
+
+def sse_message(event_id, kind: str, data: str) -> str:
+    return f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n"
+
+
+# -------------------------
+# Condition assignment (Quota)
+# -------------------------
+CONDITION_CELLS = [
+    ("pre",  "focused"),
+    ("pre",  "generic"),
+    ("none", "focused"),
+    ("none", "generic"),
+]
+
+
+def count_condition_cells(cur):
+    counts = {}
+    for p, f in CONDITION_CELLS:
+        c = cur.execute("""
+          SELECT COUNT(*) AS c
+          FROM condition_assign
+          WHERE condition_planning=? AND condition_feedback=?
+        """, (p, f)).fetchone()["c"]
+        counts[(p, f)] = int(c)
+    return counts
+
+
+def get_or_assign_condition(participant_id: str):
+    cohort = current_cohort()
+    with live_write_section():
+        planning, feedback, cell_count = STORAGE.assign_condition(
+            cohort, participant_id, datetime.utcnow().isoformat()
+        )
+
+        if cell_count is not None:
+            publish_event(
+                "condition", cohort=cohort or COHORT_DEFAULT, participant_id=participant_id,
+                planning=planning, feedback=feedback, cell_count=cell_count,
+            )
+    return planning, feedback
+
+
+# -------------------------
+# Assistant reply (rule-based)
+# -------------------------
+# 回复模板：模块级常量（gunicorn --preload 时在 master 里建一次，worker 共享）
+REPLY_FOCUSED_1_10 = {
+    1: "（聚焦反馈）我们开始吧。我先对齐你的目标：把想法变得更清晰并可推进。\n你想从哪个点切入？（载体 / 文化元素 / 故事氛围 / 符号颜色）",
+    2: "（聚焦反馈）继续说说你的选择：你为什么更偏向这个方向？给我 1–2 个关键词就行。",
+    3: "（聚焦反馈）你想做的成品更像什么？（海报/包装/空间导视/交互界面/短视频封面…）选一个最像的。",
+    4: "（聚焦反馈）你希望面向谁？（同龄人/游客/本地居民/学生/亲子…）给一个目标受众 + 一个使用场景。",
+    5: "（聚焦反馈）选 1 个最核心的文化元素：纹样/器物/工艺/仪式/故事。\n你最想用哪个？（写一个即可）",
+    6: "（聚焦反馈）为它加 2 个形容词：质朴/精致/热烈/神秘/克制/现代/传统… 你选哪两个？",
+    7: "（聚焦反馈）确定视觉锚点：你希望突出“图形符号”还是“故事画面”？二选一。",
+    8: "（聚焦反馈）来一句话概念（15字以内）：用“把___变成___”的句式写一下，我帮你润色。",
+    9: "（聚焦反馈）最后校验风格：你希望整体更“现代极简”还是“传统丰富”？二选一。",
+    10: "（聚焦反馈）总结一下：\n- 载体：{carrier}\n- 受众/场景：{aud}\n- 核心元素：{elem}\n- 气质：{adj}\n- 概念句：{concept}\n\n如果你同意，建议下一步：①列3个参考 ②画2版构图草图。"
+}
+
+REPLY_GENERIC_1_10 = {
+    1: "（通用反馈）我们开始吧。你想先从哪个点说起：载体 / 文化元素 / 故事氛围 / 符号颜色？",
+    2: "（通用反馈）为什么选这个方向？给我 1–2 个关键词就好。",
+    3: "（通用反馈）你想做的成品更像什么？（海报/包装/导视/界面/封面…）",
+    4: "（通用反馈）给一个目标受众 + 一个使用场景。",
+    5: "（通用反馈）选 1 个最核心的文化元素（纹样/器物/工艺/仪式/故事…）。",
+    6: "（通用反馈）再加 2 个形容词（比如热烈/克制/现代/传统…）。",
+    7: "（通用反馈）更想突出“图形符号”还是“故事画面”？",
+    8: "（通用反馈）写一句 15 字以内的概念句（“把___变成___”）。",
+    9: "（通用反馈）更偏“现代极简”还是“传统丰富”？",
+    10: "（通用反馈）我们把要点收一下：载体/受众/元素/气质/概念句。下一步建议做参考收集+草图。"
+}
+
+REPLY_FOCUSED_11_20 = {
+    11: "（反思阶段）我们退一步看整体：你觉得目前概念里最清晰的一点是什么？（一句话）",
+    12: "（反思阶段）那最模糊/最不确定的一点是什么？（一句话）",
+    13: "（反思阶段）如果让它更可落地：你愿意优先改“内容表达”还是“形式呈现”？二选一。",
+    14: "（反思阶段）给它一个明确的核心信息（10–15字）：你希望观众看完记住什么？",
+    15: "（反思阶段）做一次风险检查：最可能被误解的地方是什么？你想怎么避免？",
+    16: "（反思阶段）给 3 个关键词作为设计约束（例如：材质/色彩/符号风格）。你给哪 3 个？",
+    17: "（反思阶段）请列 2 个你想参考的方向（品牌/作品类型/风格流派都行），为什么？",
+    18: "（反思阶段）如果把它做成 A/B 两个版本：A更传统，B更当代。你更想保留哪一点不变？",
+    19: "（反思阶段）自评一下：现在你对这个方案的清晰度从 1–7 你给几分？为什么？",
+    20: "（反思阶段）最后收束：①你下一步最可执行的一件事是什么？②你希望我继续帮你做“润色概念句”还是“拆成制作清单”？"
+}
+
+REPLY_GENERIC_11_20 = {
+    11: "（反思）你觉得现在最清楚的一点是什么？（一句话）",
+    12: "（反思）你觉得最不确定的一点是什么？（一句话）",
+    13: "（反思）想继续完善的话，你更想改内容还是改形式？",
+    14: "（反思）用 10–15 字写一句核心信息：你希望观众记住什么？",
+    15: "（反思）你担心它会被怎么误解？",
+    16: "（反思）给 3 个关键词当作约束（材质/色彩/符号风格）。",
+    17: "（反思）列 2 个你想参考的方向，并说原因。",
+    18: "（反思）如果做 A/B 两版（传统/当代），你更想保留什么不变？",
+    19: "（反思）你对现在方案清晰度 1–7 给几分？为什么？",
+    20: "（反思）最后：你下一步最可执行的一件事是什么？"
+}
+
+
+def generate_assistant_reply(planning_cond: str, feedback_cond: str, user_text: str, turn_id=None) -> str:
+    t = int(turn_id or 1)
+    u = (user_text or "").strip()
 
     # session 记忆（用于第10轮填空）
     try:
@@ -331,41 +1901,216 @@ def generate_assistant_reply(planning_cond: str, feedback_cond: str, user_text:
     if feedback_cond == "focused":
         if t <= 10:
             if t == 10:
-                return focused_1_10[10].format(
+                return REPLY_FOCUSED_1_10[10].format(
                     carrier=mem.get("carrier", "（未记录）"),
                     aud=mem.get("aud", "（未记录）"),
                     elem=mem.get("elem", "（未记录）"),
                     adj=mem.get("adj", "（未记录）"),
                     concept=mem.get("concept", "（未记录）"),
                 )
-            return focused_1_10.get(t, "（聚焦反馈）继续说说你的想法，我来帮你推进。")
-        return focused_11_20.get(t, "（反思阶段）你愿意补充一句：你现在最想把哪一点变得更清楚？")
+            return REPLY_FOCUSED_1_10.get(t, "（聚焦反馈）继续说说你的想法，我来帮你推进。")
+        return REPLY_FOCUSED_11_20.get(t, "（反思阶段）你愿意补充一句：你现在最想把哪一点变得更清楚？")
     else:
         if t <= 10:
-            return generic_1_10.get(t, "（通用反馈）继续说说你的想法，我来帮你推进。")
-        return generic_11_20.get(t, "（反思）你现在最想补充说明哪一点？")
+            return REPLY_GENERIC_1_10.get(t, "（通用反馈）继续说说你的想法，我来帮你推进。")
+        return REPLY_GENERIC_11_20.get(t, "（反思）你现在最想补充说明哪一点？")
 
 
 # -------------------------
-# T2 eligibility
+# Chat archive（完成 T2 的参与者：chat_log → chat_archive）
 # -------------------------
-def get_t2_eligibility(pid: str):
-    conn = db_conn()
-    row = conn.execute(
-        "SELECT created_at FROM survey_t1 WHERE participant_id=?",
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "200"))
+# >0 时后台定时归档（秒）；0 = 只通过 /_admin/archive 手动触发
+ARCHIVE_INTERVAL_SEC = int(os.environ.get("ARCHIVE_INTERVAL_SEC", "0"))
+# 每次归档后最多回收多少空闲页（incremental_vacuum）
+ARCHIVE_VACUUM_PAGES = int(os.environ.get("ARCHIVE_VACUUM_PAGES", "2000"))
+
+
+def encode_chat_archive(cols, rows) -> bytes:
+    return zlib.compress(
+        json.dumps({"cols": cols, "rows": rows}, ensure_ascii=False).encode("utf-8")
+    )
+
+
+def decode_chat_archive(payload: bytes):
+    data = json.loads(zlib.decompress(payload).decode("utf-8"))
+    return data["cols"], data["rows"]
+
+
+def count_user_turns(conn, pid: str) -> int:
+    live = conn.execute("""
+      SELECT COUNT(*) AS c FROM chat_log
+      WHERE participant_id=? AND role=?
+    """, (pid, chat_role_value(conn.storage_format, "user"))).fetchone()["c"]
+
+    archived = conn.execute(
+        "SELECT n_user_turns FROM chat_archive WHERE participant_id=?",
         (pid,)
     ).fetchone()
-    conn.close()
 
+    return int(live) + (int(archived["n_user_turns"]) if archived else 0)
+
+
+def archive_participant_chat(cur, pid: str) -> int:
+    """在调用方的事务里归档一个参与者；返回搬走的行数"""
+    # 归档里一律存逻辑格式（text 库的列和值），compact 库在这里解码
+    cur.execute(logical_select(cur.connection, "chat_log") + " WHERE participant_id=? ORDER BY id", (pid,))
+    cols = [d[0] for d in cur.description]
+    rows = logical_rows(cur.connection, "chat_log", cur.fetchall())
+    if not rows:
+        return 0
+
+    # 归档后又有新对话（极少）：和旧归档合并
+    old = cur.execute(
+        "SELECT payload FROM chat_archive WHERE participant_id=?",
+        (pid,)
+    ).fetchone()
+    if old:
+        _, old_rows = decode_chat_archive(old["payload"])
+        rows = old_rows + rows
+
+    role_idx = cols.index("role")
+    n_user_turns = sum(1 for r in rows if r[role_idx] == "user")
+
+    cur.execute("""
+      INSERT OR REPLACE INTO chat_archive(participant_id, n_rows, n_user_turns, payload, archived_at)
+      VALUES (?, ?, ?, ?, ?)
+    """, (pid, len(rows), n_user_turns, encode_chat_archive(cols, rows), datetime.utcnow().isoformat()))
+    cur.execute("DELETE FROM chat_log WHERE participant_id=?", (pid,))
+    return len(rows)
+
+
+def archive_completed_participants(cohort: str = "", full_vacuum: bool = False):
+    """
+    把已提交 survey_t2 的参与者的 chat_log 搬进 chat_archive。
+    每批一个短事务，避免长时间占写锁；最后做 incremental_vacuum 回收空间。
+    """
+    conn = db_conn(cohort)
+    cur = conn.cursor()
+    archived_pids = 0
+    archived_rows = 0
+
+    try:
+        while True:
+            pids = [r["participant_id"] for r in cur.execute("""
+              SELECT s.participant_id FROM survey_t2 s
+              WHERE EXISTS (SELECT 1 FROM chat_log c WHERE c.participant_id = s.participant_id)
+              LIMIT ?
+            """, (ARCHIVE_BATCH_SIZE,)).fetchall()]
+            if not pids:
+                break
+
+            cur.execute("BEGIN IMMEDIATE;")
+            try:
+                for pid in pids:
+                    archived_rows += archive_participant_chat(cur, pid)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            archived_pids += len(pids)
+
+        auto_vacuum = cur.execute("PRAGMA auto_vacuum;").fetchone()[0]
+        if full_vacuum and auto_vacuum != 2:
+            # 老库一次性切换到 INCREMENTAL（会锁库，放在非高峰手动触发）
+            cur.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            cur.execute("VACUUM;")
+            auto_vacuum = 2
+        elif auto_vacuum == 2:
+            cur.execute(f"PRAGMA incremental_vacuum({int(ARCHIVE_VACUUM_PAGES)});").fetchall()
+
+        freelist = cur.execute("PRAGMA freelist_count;").fetchone()[0]
+    finally:
+        conn.close()
+
+    return {
+        "cohort": cohort or COHORT_DEFAULT,
+        "participants": archived_pids,
+        "rows": archived_rows,
+        "auto_vacuum": "incremental" if auto_vacuum == 2 else "none",
+        "freelist_pages": freelist,
+    }
+
+
+_ARCHIVER_PID = None
+_ARCHIVER_LOCK = threading.Lock()
+# 多个 gunicorn worker 各有一个归档线程，但只有拿到这个文件锁的那个干活（和 backup.py 的复制线程一样）；
+# 它退出后锁自动释放，下一轮别的 worker 接手
+ARCHIVER_LOCK_PATH = os.path.join(COHORT_DIR or ".", ".archiver.lock")
+_ARCHIVER_LOCK_FILE = None
+
+
+def _archiver_try_lead() -> bool:
+    global _ARCHIVER_LOCK_FILE
+    if _ARCHIVER_LOCK_FILE is not None:
+        return True
+    os.makedirs(os.path.dirname(ARCHIVER_LOCK_PATH), exist_ok=True)
+    f = open(ARCHIVER_LOCK_PATH, "a+")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _ARCHIVER_LOCK_FILE = f
+    return True
+
+
+def _archiver_loop():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL_SEC)
+        if not _archiver_try_lead():
+            continue
+        for c in list_cohorts():
+            try:
+                archive_completed_participants(c)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+
+@app.before_request
+def start_archiver_once():
+    # 在 worker 里第一次请求时才起线程（gunicorn fork 之后）；每个 worker 都起，靠 ARCHIVER_LOCK_PATH 选一个干活
+    global _ARCHIVER_PID
+    if _ARCHIVER_PID == os.getpid() or ARCHIVE_INTERVAL_SEC <= 0 or STORAGE.name != "sqlite":
+        return
+    with _ARCHIVER_LOCK:
+        if _ARCHIVER_PID != os.getpid():
+            threading.Thread(target=_archiver_loop, name="chat-archiver", daemon=True).start()
+            _ARCHIVER_PID = os.getpid()
+
+
+@app.before_request
+def start_backup_once():
+    # 同样在 fork 之后才起；多个 worker 都会起线程，但只有拿到备份目录文件锁的那个真正复制
+    if BACKUP_DIR and STORAGE.name == "sqlite":
+        backup.start_replicator(
+            BACKUP_DIR,
+            lambda: [cohort_db_path(c) for c in list_cohorts()],
+            interval_sec=BACKUP_INTERVAL_SEC,
+            snapshot_every_sec=BACKUP_SNAPSHOT_SEC,
+            keep_generations=BACKUP_KEEP_GENERATIONS,
+        )
+
+
+# -------------------------
+# T2 eligibility
+# -------------------------
+def get_t2_eligibility(pid: str):
+    # 每次都按主键查库（不做进程内缓存）：重交 T1 会改 eligible_at，别的 worker 的缓存不会跟着失效
+    row = STORAGE.t1_times(current_cohort(), pid)
     if not row:
         return (False, None, "t1_not_submitted")
 
+    created_at, stored_eligible_at = row
     try:
-        t1_at = datetime.fromisoformat(row["created_at"])
+        if stored_eligible_at:
+            eligible_at = datetime.fromisoformat(stored_eligible_at)
+        else:
+            eligible_at = compute_t2_eligible_at(datetime.fromisoformat(created_at))
     except Exception:
         return (False, None, "t1_time_parse_error")
 
-    eligible_at = t1_at + timedelta(days=T2_DELAY_DAYS)
     now = datetime.utcnow()
 
     if now < eligible_at:
@@ -374,6 +2119,19 @@ def get_t2_eligibility(pid: str):
     return (True, eligible_at.isoformat(), "ok")
 
 
+def to_naive_utc(dt: datetime) -> datetime:
+    """库里的时间都是 naive UTC（按字符串比较）；带时区的先换算，不能直接去掉时区"""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def list_t2_eligible_between(start: datetime, end: datetime, cohort: str = "", pending_only: bool = True):
+    """[start, end) 之间开放 T2 的参与者（走 eligible_at 索引），用于发提醒"""
+    start, end = to_naive_utc(start), to_naive_utc(end)
+    return STORAGE.t2_eligible_between(cohort, start.isoformat(), end.isoformat(), pending_only)
+
+
 # -------------------------
 # Routes
 # -------------------------
@@ -385,25 +2143,45 @@ def home():
 @app.route("/consent", methods=["GET", "POST"])
 def consent():
     if request.method == "GET":
-        return render_template("consent.html")
+        return render_template("consent.html", cohort=normalize_cohort(request.args.get("cohort")))
+
+    raw_cohort = (request.form.get("cohort") or request.args.get("cohort") or "").strip()
+    cohort = normalize_cohort(raw_cohort)
+    if raw_cohort and raw_cohort != COHORT_DEFAULT and not cohort:
+        return "Invalid cohort", 400
+    if cohort and cohort not in COHORTS and not cohort_exists(cohort):
+        return "Unknown cohort", 400
 
     participant_id = str(uuid.uuid4())
     now = datetime.utcnow().isoformat()
 
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO participants (participant_id, consent_time, created_at)
-        VALUES (?, ?, ?)
-    """, (participant_id, now, now))
-    conn.commit()
-    conn.close()
+    STORAGE.create_cohort(cohort)
+
+    register_pid_cohort(participant_id, cohort)
+    if cohort:
+        session["cohort"] = cohort
+    else:
+        session.pop("cohort", None)
+
+    with live_write_section():
+        STORAGE.create_participant(cohort, participant_id, now)
+        publish_event("consent", cohort=cohort or COHORT_DEFAULT, participant_id=participant_id)
 
     session["participant_id"] = participant_id
     return redirect(url_for("baseline_page", pid=participant_id))
 
 
+BASELINE_COLUMNS = ["participant_id", "grade_major", "culture_course", "chatbot_exp", "stress_1w", "created_at"]
+MATERIAL_CHOICE_COLUMNS = [
+    "participant_id", "chosen_direction", "chosen_label", "page_time", "choice_time", "rt_ms", "user_agent",
+]
+PLANNING_COLUMNS = [
+    "participant_id", "plan_goal", "plan_audience_context", "plan_elements", "plan_output", "created_at",
+]
+
+
 @app.route("/baseline", methods=["GET", "POST"])
+@admission_controlled
 def baseline_page():
     pid = get_pid_from_request()
     if not pid:
@@ -420,25 +2198,16 @@ def baseline_page():
     if not grade_major:
         return "grade_major required", 400
 
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("""
-      INSERT INTO baseline(participant_id, grade_major, culture_course, chatbot_exp, stress_1w, created_at)
-      VALUES (?, ?, ?, ?, ?, ?)
-      ON CONFLICT(participant_id) DO UPDATE SET
-        grade_major=excluded.grade_major,
-        culture_course=excluded.culture_course,
-        chatbot_exp=excluded.chatbot_exp,
-        stress_1w=excluded.stress_1w,
-        created_at=excluded.created_at
-    """, (pid, grade_major, culture_course, chatbot_exp, stress_1w, datetime.utcnow().isoformat()))
-    conn.commit()
-    conn.close()
+    STORAGE.upsert(
+        current_cohort(), "baseline", BASELINE_COLUMNS,
+        (pid, grade_major, culture_course, chatbot_exp, stress_1w, datetime.utcnow().isoformat()),
+    )
 
     return redirect(url_for("material_page", pid=pid))
 
 
 @app.route("/api/baseline", methods=["POST"])
+@admission_controlled
 def api_baseline():
     data = request.get_json(force=True)
 
@@ -451,20 +2220,10 @@ def api_baseline():
     if not pid or not grade_major:
         return jsonify({"ok": False, "error": "missing participant_id or grade_major"}), 400
 
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("""
-      INSERT INTO baseline(participant_id, grade_major, culture_course, chatbot_exp, stress_1w, created_at)
-      VALUES (?, ?, ?, ?, ?, ?)
-      ON CONFLICT(participant_id) DO UPDATE SET
-        grade_major=excluded.grade_major,
-        culture_course=excluded.culture_course,
-        chatbot_exp=excluded.chatbot_exp,
-        stress_1w=excluded.stress_1w,
-        created_at=excluded.created_at
-    """, (pid, grade_major, culture_course, chatbot_exp, stress_1w, datetime.utcnow().isoformat()))
-    conn.commit()
-    conn.close()
+    STORAGE.upsert(
+        current_cohort(), "baseline", BASELINE_COLUMNS,
+        (pid, grade_major, culture_course, chatbot_exp, stress_1w, datetime.utcnow().isoformat()),
+    )
 
     return jsonify({"ok": True, "next": url_for("material_page", pid=pid)})
 
@@ -478,6 +2237,7 @@ def material_page():
 
 
 @app.route("/api/material_choice", methods=["POST"])
+@admission_controlled
 def api_material_choice():
     data = request.get_json(force=True)
     pid = (data.get("participant_id") or "").strip()
@@ -490,28 +2250,17 @@ def api_material_choice():
     if not pid or not choice:
         return jsonify({"ok": False, "error": "missing participant_id or choice"}), 400
 
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("""
-    INSERT INTO material_choice
-      (participant_id, chosen_direction, chosen_label, page_time, choice_time, rt_ms, user_agent)
-    VALUES (?, ?, ?, ?, ?, ?, ?)
-    ON CONFLICT(participant_id) DO UPDATE SET
-      chosen_direction=excluded.chosen_direction,
-      chosen_label=excluded.chosen_label,
-      page_time=excluded.page_time,
-      choice_time=excluded.choice_time,
-      rt_ms=excluded.rt_ms,
-      user_agent=excluded.user_agent
-    """, (pid, choice, label, page_time, datetime.utcnow().isoformat(), rt_ms, user_agent))
-    conn.commit()
-    conn.close()
+    STORAGE.upsert(
+        current_cohort(), "material_choice", MATERIAL_CHOICE_COLUMNS,
+        (pid, choice, label, page_time, datetime.utcnow().isoformat(), rt_ms, user_agent),
+    )
 
     get_or_assign_condition(pid)
     return jsonify({"ok": True})
 
 
 @app.route("/planning", methods=["GET", "POST"])
+@admission_controlled
 def planning_page():
     pid = get_pid_from_request()
     if not pid:
@@ -533,20 +2282,10 @@ def planning_page():
     if not (plan_goal and plan_audience_context and plan_elements and plan_output):
         return "All planning fields required", 400
 
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("""
-      INSERT INTO planning_input(participant_id, plan_goal, plan_audience_context, plan_elements, plan_output, created_at)
-      VALUES (?, ?, ?, ?, ?, ?)
-      ON CONFLICT(participant_id) DO UPDATE SET
-        plan_goal=excluded.plan_goal,
-        plan_audience_context=excluded.plan_audience_context,
-        plan_elements=excluded.plan_elements,
-        plan_output=excluded.plan_output,
-        created_at=excluded.created_at
-    """, (pid, plan_goal, plan_audience_context, plan_elements, plan_output, datetime.utcnow().isoformat()))
-    conn.commit()
-    conn.close()
+    STORAGE.upsert(
+        current_cohort(), "planning_input", PLANNING_COLUMNS,
+        (pid, plan_goal, plan_audience_context, plan_elements, plan_output, datetime.utcnow().isoformat()),
+    )
 
     return redirect(url_for("chat_page", pid=pid))
 
@@ -559,22 +2298,11 @@ def chat_page():
 
     planning_cond, feedback_cond = get_or_assign_condition(pid)
 
-    if planning_cond == "pre":
-        conn = db_conn()
-        row = conn.execute(
-            "SELECT 1 FROM planning_input WHERE participant_id=?",
-            (pid,)
-        ).fetchone()
-        conn.close()
-        if not row:
-            return redirect(url_for("planning_page", pid=pid))
+    cohort = current_cohort()
+    if planning_cond == "pre" and not STORAGE.has_row(cohort, "planning_input", pid):
+        return redirect(url_for("planning_page", pid=pid))
 
-    conn = db_conn()
-    user_turns = conn.execute("""
-      SELECT COUNT(*) AS c FROM chat_log
-      WHERE participant_id=? AND role='user'
-    """, (pid,)).fetchone()["c"]
-    conn.close()
+    user_turns = STORAGE.count_user_turns(cohort, pid)
 
     return render_template(
         "chat.html",
@@ -586,6 +2314,7 @@ def chat_page():
 
 
 @app.route("/api/chat_send", methods=["POST"])
+@admission_controlled
 def api_chat_send():
     try:
         data = request.get_json(force=True)
@@ -595,49 +2324,31 @@ def api_chat_send():
         if not pid or not user_text:
             return jsonify({"ok": False, "error": "missing participant_id or text"}), 400
 
-        conn = db_conn()
-        cur = conn.cursor()
-
-        cur.execute("""
-            INSERT OR IGNORE INTO participants(participant_id, created_at)
-            VALUES (?, datetime('now'))
-        """, (pid,))
-        conn.commit()
+        cohort = current_cohort()
+        STORAGE.ensure_participant(cohort, pid, datetime.utcnow().isoformat())
 
         planning_cond, feedback_cond = get_or_assign_condition(pid)
 
-        current_user_turns = cur.execute("""
-            SELECT COUNT(*) AS c FROM chat_log
-            WHERE participant_id=? AND role='user'
-        """, (pid,)).fetchone()["c"]
-        next_turn_id = int(current_user_turns) + 1
+        with live_write_section():
+            next_turn_id, assistant_text = STORAGE.append_chat_turn(
+                cohort, pid, user_text,
+                lambda turn_id: generate_assistant_reply(
+                    planning_cond=planning_cond,
+                    feedback_cond=feedback_cond,
+                    user_text=user_text,
+                    turn_id=turn_id
+                ),
+                MAX_TURNS, datetime.utcnow(),
+            )
+            if next_turn_id is not None:
+                publish_event(
+                    "chat_turn", cohort=cohort or COHORT_DEFAULT, participant_id=pid,
+                    turn_id=next_turn_id, feedback=feedback_cond,
+                )
 
-        if next_turn_id > MAX_TURNS:
-            conn.close()
+        if next_turn_id is None:
             return jsonify({"ok": False, "error": "max_turns_reached"}), 400
 
-        now = datetime.utcnow().isoformat()
-
-        cur.execute("""
-            INSERT INTO chat_log(participant_id, turn_id, role, text, ts)
-            VALUES (?, ?, 'user', ?, ?)
-        """, (pid, next_turn_id, user_text, now))
-
-        assistant_text = generate_assistant_reply(
-            planning_cond=planning_cond,
-            feedback_cond=feedback_cond,
-            user_text=user_text,
-            turn_id=next_turn_id
-        )
-
-        cur.execute("""
-            INSERT INTO chat_log(participant_id, turn_id, role, text, ts)
-            VALUES (?, ?, 'assistant', ?, ?)
-        """, (pid, next_turn_id, assistant_text, now))
-
-        conn.commit()
-        conn.close()
-
         can_finish = (next_turn_id >= T1_THRESHOLD)
 
         return jsonify({
@@ -655,128 +2366,186 @@ def api_chat_send():
         return jsonify({"ok": False, "error": f"{type(e).__name__}: {str(e)}"}), 500
 
 
+def survey_page(inst: SurveyInstrument, pid: str):
+    """所有问卷共用：门槛检查 → GET 渲染 / POST 一次解析 + 一条 upsert"""
+    if inst.gate is not None:
+        ok, eligible_at_iso, reason = inst.gate(pid)
+
+        if not ok:
+            if reason == "t1_not_submitted":
+                return redirect(url_for("t1_page", pid=pid))
+            if not inst.locked_template:
+                return "Survey not open yet", 403
+
+            # 锁定页只取决于 (pid, eligible_at)：反复刷新时回 304，不重新渲染
+            # pid 是用户给的，可能带引号等 ETag 里不能出现的字符 → 取哈希
+            digest = hashlib.blake2b(f"{pid}\n{eligible_at_iso}".encode("utf-8"), digest_size=12).hexdigest()
+            etag = f"{inst.name}-locked-{digest}"
+            if request.method == "GET" and request.if_none_match.contains(etag):
+                resp = Response(status=304)
+            else:
+                resp = make_response(render_template(inst.locked_template, participant_id=pid, eligible_at=eligible_at_iso))
+            resp.set_etag(etag)
+            resp.headers["Cache-Control"] = "private, no-cache"
+            return resp
+
+    if request.method == "GET":
+        return render_template(inst.template, participant_id=pid)
+
+    params = inst.parse(request.form, pid, datetime.utcnow())
+
+    with live_write_section():
+        STORAGE.upsert(current_cohort(), inst.table, inst.upsert_columns, params)
+        publish_event(inst.name, cohort=current_cohort() or COHORT_DEFAULT, participant_id=pid)
+
+    return render_template(inst.done_template, participant_id=pid)
+
+
 @app.route("/t1", methods=["GET", "POST"])
+@admission_controlled
 def t1_page():
     pid = (request.args.get("pid") or "").strip()
     if not pid:
         return "Missing pid", 400
-
-    if request.method == "GET":
-        return render_template("survey_t1.html", participant_id=pid)
-
-    def as_int(name):
-        v = request.form.get(name, "")
-        return int(v) if str(v).isdigit() else None
-
-    payload = (
-        pid,
-        as_int("ti1"), as_int("ti2"), as_int("ti3"),
-        as_int("s1"), as_int("s2"), as_int("s3"), as_int("s4"),
-        as_int("c1"), as_int("c2"), as_int("c3"), as_int("c4"),
-        as_int("task1"), as_int("task2"), as_int("task3"),
-        as_int("aff1"), as_int("aff2"), as_int("aff3"),
-        as_int("mplan"), as_int("mfb"),
-        datetime.utcnow().isoformat()
-    )
-
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("""
-      INSERT INTO survey_t1(
-        participant_id,
-        triggered_interest_1, triggered_interest_2, triggered_interest_3,
-        support_1, support_2, support_3, support_4,
-        clarity_1, clarity_2, clarity_3, clarity_4,
-        task_1, task_2, task_3,
-        affect_1, affect_2, affect_3,
-        manip_plan, manip_feedback,
-        created_at
-      ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-      ON CONFLICT(participant_id) DO UPDATE SET
-        triggered_interest_1=excluded.triggered_interest_1,
-        triggered_interest_2=excluded.triggered_interest_2,
-        triggered_interest_3=excluded.triggered_interest_3,
-        support_1=excluded.support_1,
-        support_2=excluded.support_2,
-        support_3=excluded.support_3,
-        support_4=excluded.support_4,
-        clarity_1=excluded.clarity_1,
-        clarity_2=excluded.clarity_2,
-        clarity_3=excluded.clarity_3,
-        clarity_4=excluded.clarity_4,
-        task_1=excluded.task_1,
-        task_2=excluded.task_2,
-        task_3=excluded.task_3,
-        affect_1=excluded.affect_1,
-        affect_2=excluded.affect_2,
-        affect_3=excluded.affect_3,
-        manip_plan=excluded.manip_plan,
-        manip_feedback=excluded.manip_feedback,
-        created_at=excluded.created_at
-    """, payload)
-    conn.commit()
-    conn.close()
-
-    return render_template("done_t1.html", participant_id=pid)
+    return survey_page(INSTRUMENTS["t1"], pid)
 
 
 @app.route("/t2", methods=["GET", "POST"])
+@admission_controlled
 def t2_page():
     pid = get_pid_from_request()
     if not pid:
         return "Missing pid", 400
+    return survey_page(INSTRUMENTS["t2"], pid)
+
+
+# 新问卷（T3、追加量表）不用写 handler：在 INSTRUMENTS 里登记后走 /survey/<name>
+@app.route("/survey/<name>", methods=["GET", "POST"])
+@admission_controlled
+def instrument_page(name):
+    inst = INSTRUMENTS.get(name)
+    if inst is None:
+        abort(404)
+    pid = get_pid_from_request()
+    if not pid:
+        return "Missing pid", 400
+    return survey_page(inst, pid)
 
-    ok, eligible_at_iso, reason = get_t2_eligibility(pid)
 
-    if not ok:
-        if reason == "t1_not_submitted":
-            return redirect(url_for("t1_page", pid=pid))
-        return render_template("t2_locked.html", participant_id=pid, eligible_at=eligible_at_iso)
+# -------------------------
+# Client telemetry（前端过程数据：浏览器攒一批再发，服务端一次 executemany 写入）
+#   POST /api/telemetry?pid=xxx
+#   body：{"participant_id": "...", "events": [{"type": "page_view", "page": "chat", "t": <客户端毫秒>, "data": {...}}, ...]}
+#         或直接是事件数组。Content-Type 可以是 application/json，也可以是 text/plain（navigator.sendBeacon 发字符串）
+#   前端见 static/telemetry.js
+# -------------------------
+TELEMETRY_MAX_BYTES = int(os.environ.get("TELEMETRY_MAX_BYTES", str(64 * 1024)))
+TELEMETRY_MAX_EVENTS = int(os.environ.get("TELEMETRY_MAX_EVENTS", "200"))
+TELEMETRY_MAX_DATA_BYTES = 2048
+TELEMETRY_TYPE_RE = re.compile(r"^[a-z][a-z0-9_]{0,31}$")
+# client_ts 存 INTEGER（SQLite / BIGINT）：超出 int64 的（1e30、Infinity）当作没给
+TELEMETRY_TS_MAX = 2 ** 63 - 1
+
+# 限流：自己的桶，不和 /api/chat_send 等写接口抢同一个 pid 桶 / 全局写 slot（大小已经由上面几项卡住）
+#   telemetry.js 自己控制发送间隔（>= 2 秒一批）保证在桶内，离开页面的那次 sendBeacon 没法重试，不能被 429 掉
+RL_TELEMETRY_PID_RATE = float(os.environ.get("RL_TELEMETRY_PID_RATE", "1"))
+RL_TELEMETRY_PID_BURST = float(os.environ.get("RL_TELEMETRY_PID_BURST", "10"))
+RL_TELEMETRY_IP_RATE = float(os.environ.get("RL_TELEMETRY_IP_RATE", "50"))
+RL_TELEMETRY_IP_BURST = float(os.environ.get("RL_TELEMETRY_IP_BURST", "200"))
+
+
+def parse_telemetry_events(events, pid: str, received_at: str):
+    """校验 + 整理成行；不合格的事件丢掉（不让一条坏数据拖垮整批）。返回 (rows, dropped)"""
+    rows = []
+    dropped = max(0, len(events) - TELEMETRY_MAX_EVENTS)
+    for ev in events[:TELEMETRY_MAX_EVENTS]:
+        if not isinstance(ev, dict) or not TELEMETRY_TYPE_RE.match(str(ev.get("type") or "")):
+            dropped += 1
+            continue
+
+        client_ts = ev.get("t")
+        if (isinstance(client_ts, (int, float)) and not isinstance(client_ts, bool)
+                and math.isfinite(client_ts) and -TELEMETRY_TS_MAX - 1 <= client_ts <= TELEMETRY_TS_MAX):
+            client_ts = int(client_ts)
+        else:
+            client_ts = None
+
+        data = ev.get("data")
+        data = json.dumps(data, ensure_ascii=False, separators=(",", ":")) if data is not None else None
+        if data is not None and len(data.encode("utf-8")) > TELEMETRY_MAX_DATA_BYTES:
+            dropped += 1
+            continue
+
+        page = str(ev.get("page") or "")[:32] or None
+        rows.append((pid, ev["type"], page, client_ts, data, received_at))
+    return rows, dropped
+
+
+def telemetry_rate_limited(view):
+    """和 admission_controlled 一样对限流存储出错时放行；只扣 telemetry 自己的桶"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not RATELIMIT_ENABLED:
+            return view(*args, **kwargs)
+
+        pid = (request.args.get("pid") or "").strip()
+        ip = client_ip()
+        buckets = []
+        if pid:
+            buckets.append(("tel:pid:" + pid, RL_TELEMETRY_PID_RATE, RL_TELEMETRY_PID_BURST))
+        if ip:
+            buckets.append(("tel:ip:" + ip, RL_TELEMETRY_IP_RATE, RL_TELEMETRY_IP_BURST))
+
+        try:
+            wait = take_tokens(buckets)
+        except sqlite3.Error:
+            import traceback
+            traceback.print_exc()
+            return view(*args, **kwargs)
+
+        if wait > 0:
+            return too_many_requests(wait)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.before_request
+def limit_telemetry_body():
+    # 在任何东西读 body 之前卡住大小
+    if request.endpoint == "api_telemetry" and request.method == "POST":
+        if request.content_length is None:
+            return jsonify({"ok": False, "error": "length_required"}), 411
+        if request.content_length > TELEMETRY_MAX_BYTES:
+            return jsonify({"ok": False, "error": "payload_too_large", "max_bytes": TELEMETRY_MAX_BYTES}), 413
+
+
+@app.route("/api/telemetry", methods=["POST"])
+@telemetry_rate_limited
+def api_telemetry():
+    try:
+        payload = json.loads(request.get_data(cache=True) or b"null")
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid_json"}), 400
 
-    if request.method == "GET":
-        return render_template("t2.html", participant_id=pid)
-
-    def as_int(name):
-        v = request.form.get(name, "")
-        return int(v) if str(v).isdigit() else None
-
-    payload = (
-        pid,
-        as_int("mi1"), as_int("mi2"), as_int("mi3"),
-        as_int("s1"), as_int("s2"), as_int("s3"),
-        as_int("c1"), as_int("c2"), as_int("c3"),
-        as_int("cont1"),
-        datetime.utcnow().isoformat()
-    )
+    pid = (request.args.get("pid") or "").strip()
+    events = payload
+    if isinstance(payload, dict):
+        pid = pid or str(payload.get("participant_id") or "").strip()
+        events = payload.get("events")
+    if not pid or not isinstance(events, list):
+        return jsonify({"ok": False, "error": "missing participant_id or events"}), 400
 
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("""
-      INSERT INTO survey_t2(
-        participant_id,
-        maintained_interest_1, maintained_interest_2, maintained_interest_3,
-        support_1, support_2, support_3,
-        clarity_1, clarity_2, clarity_3,
-        cont_intent_1,
-        created_at
-      ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
-      ON CONFLICT(participant_id) DO UPDATE SET
-        maintained_interest_1=excluded.maintained_interest_1,
-        maintained_interest_2=excluded.maintained_interest_2,
-        maintained_interest_3=excluded.maintained_interest_3,
-        support_1=excluded.support_1,
-        support_2=excluded.support_2,
-        support_3=excluded.support_3,
-        clarity_1=excluded.clarity_1,
-        clarity_2=excluded.clarity_2,
-        clarity_3=excluded.clarity_3,
-        cont_intent_1=excluded.cont_intent_1,
-        created_at=excluded.created_at
-    """, payload)
-    conn.commit()
-    conn.close()
+    # 只收已经登记过的参与者；写到登记的那个库（不看 URL / session 上的 cohort）
+    cohort = lookup_pid_cohort(pid)
+    if cohort is None:
+        return jsonify({"ok": False, "error": "unknown participant_id"}), 404
+
+    rows, dropped = parse_telemetry_events(events, pid, datetime.utcnow().isoformat())
+    if rows:
+        STORAGE.append_client_events(cohort, rows)
 
-    return render_template("done_t2.html", participant_id=pid)
+    return jsonify({"ok": True, "accepted": len(rows), "dropped": dropped})
 
 
 # -------------------------
@@ -784,31 +2553,189 @@ def t2_page():
 # -------------------------
 @app.route("/_debug/counts")
 def debug_counts():
-    conn = db_conn()
-    cur = conn.cursor()
+    return jsonify(STORAGE.table_counts(current_cohort(), EXPORT_TABLES))
+
+
+# -------------------------
+# Live monitoring（SSE）
+#   /_live?token=xxx          研究者看板
+#   /_live/stream?token=xxx   事件流（EventSource 断线自动带 Last-Event-ID 重连）
+# 注意：一条 SSE 连接会占住一个 worker 线程，gunicorn 需要 gthread（--threads）
+# -------------------------
+@app.route("/_live")
+def live_page():
+    denied = require_export_token_or_403()
+    if denied:
+        return denied
+    return render_template("live.html", token=request.args.get("token", ""))
 
-    def q(sql):
-        cur.execute(sql)
-        return cur.fetchone()[0]
-
-    counts = {
-        "participants": q("SELECT COUNT(*) FROM participants;"),
-        "condition_assign": q("SELECT COUNT(*) FROM condition_assign;"),
-        "baseline": q("SELECT COUNT(*) FROM baseline;"),
-        "material_choice": q("SELECT COUNT(*) FROM material_choice;"),
-        "planning_input": q("SELECT COUNT(*) FROM planning_input;"),
-        "chat_log": q("SELECT COUNT(*) FROM chat_log;"),
-        "survey_t1": q("SELECT COUNT(*) FROM survey_t1;"),
-        "survey_t2": q("SELECT COUNT(*) FROM survey_t2;"),
+
+@app.route("/_live/stream")
+def live_stream():
+    denied = require_export_token_or_403()
+    if denied:
+        return denied
+
+    raw_last = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or ""
+    last_id = int(raw_last) if raw_last.isdigit() else None
+
+    ensure_live_tail()
+
+    def generate():
+        cursor = last_id
+        replay = live_replay(cursor) if cursor is not None else None
+
+        yield "retry: 3000\n\n"
+        if replay is None:
+            # 新连接 / 续不上：先发一次全量计数，再从游标之后开始推
+            cursor, counts = live_snapshot()
+            yield sse_message(cursor, "snapshot", json.dumps(counts, ensure_ascii=False))
+        else:
+            for event_id, ts, kind, data in replay:
+                yield sse_message(event_id, kind, data)
+                cursor = event_id
+
+        deadline = time.time() + LIVE_STREAM_MAX_SEC
+        while time.time() < deadline:
+            events = live_events_after(cursor, LIVE_KEEPALIVE_SEC)
+            if events is None:
+                # 缓冲被挤掉了一段，补不回来 → 重新发全量计数
+                cursor, counts = live_snapshot()
+                yield sse_message(cursor, "snapshot", json.dumps(counts, ensure_ascii=False))
+                continue
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            for event_id, ts, kind, data in events:
+                yield sse_message(event_id, kind, data)
+                cursor = event_id
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# -------------------------
+# Admin: chat archive
+#   /_admin/archive?token=xxx               （当前 cohort）
+#   /_admin/archive?token=xxx&cohort=all
+#   /_admin/archive?token=xxx&full_vacuum=1 （老库一次性切到 incremental vacuum）
+# -------------------------
+@app.route("/_admin/archive", methods=["GET", "POST"])
+def admin_archive():
+    denied = require_export_token_or_403()
+    if denied:
+        return denied
+
+    if STORAGE.name != "sqlite":
+        return jsonify({"ok": False, "error": f"chat archive is sqlite-only (backend: {STORAGE.name})"}), 404
+
+    cohorts, _ = export_cohorts()
+    full_vacuum = (request.args.get("full_vacuum") or "") == "1"
+    results = [archive_completed_participants(c, full_vacuum=full_vacuum) for c in cohorts]
+    return jsonify({"ok": True, "results": results})
+
+
+# -------------------------
+# Admin: 备份状态
+#   /_admin/backup?token=xxx   （本 worker 的复制线程状态；不是 leader 的 worker 只看到 leader=false）
+#   恢复用命令行：python backup.py restore --dir $BACKUP_DIR --db experiment --to 2025-03-01T10:00:00 --out x.db
+# -------------------------
+@app.route("/_admin/backup")
+def admin_backup():
+    denied = require_export_token_or_403()
+    if denied:
+        return denied
+
+    if not BACKUP_DIR:
+        return jsonify({"ok": False, "error": "backup disabled (BACKUP_DIR not set)"}), 404
+    status = backup.replicator_status() or {"leader": False, "databases": {}}
+    status["generations"] = {
+        backup.db_backup_name(cohort_db_path(c)): [
+            {"generation": g["generation"], "snapshot_at": g["snapshot_at"], "segments": len(g["segments"])}
+            for g in backup.list_generations(BACKUP_DIR, backup.db_backup_name(cohort_db_path(c)))
+        ]
+        for c in list_cohorts()
     }
+    return jsonify({"ok": True, **status})
 
-    conn.close()
-    return jsonify(counts)
+
+# -------------------------
+# Admin: T2 提醒名单
+#   /_admin/t2_eligible?token=xxx&from=2025-01-01T00:00&to=2025-01-02T00:00
+#   默认 from=现在，to=现在+1天；只列出还没交 T2 的（all=1 列出全部）
+#   from/to 按 UTC 解释（eligible_at 存的是 UTC）；带时区的（如 2025-01-01T08:00+08:00）先换算成 UTC
+# -------------------------
+
+@app.route("/_admin/t2_eligible")
+def admin_t2_eligible():
+    denied = require_export_token_or_403()
+    if denied:
+        return denied
+
+    try:
+        now = datetime.utcnow()
+        start = to_naive_utc(datetime.fromisoformat(request.args["from"])) if request.args.get("from") else now
+        end = to_naive_utc(datetime.fromisoformat(request.args["to"])) if request.args.get("to") else start + timedelta(days=1)
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad from/to (ISO 8601 expected)"}), 400
+
+    pending_only = (request.args.get("all") or "") != "1"
+    cohorts, _ = export_cohorts()
+    items = []
+    for c in cohorts:
+        for pid, eligible_at in list_t2_eligible_between(start, end, c, pending_only=pending_only):
+            items.append({"cohort": c or COHORT_DEFAULT, "participant_id": pid, "eligible_at": eligible_at})
+
+    return jsonify({"ok": True, "from": start.isoformat(), "to": end.isoformat(), "participants": items})
+
+
+# -------------------------
+# Export helpers
+#   默认导出当前 cohort 的库；?cohort=all 时逐个分库懒加载合并，并在最前面加一列 cohort
+# -------------------------
+EXPORT_TABLES = [
+    "participants",
+    "condition_assign",
+    "baseline",
+    "material_choice",
+    "planning_input",
+    "chat_log",
+    "survey_t1",
+    "survey_t2",
+    "client_events",
+]
+EXPORT_TABLES += [inst.table for inst in INSTRUMENTS.values() if inst.table not in EXPORT_TABLES]
+
+
+def export_cohorts():
+    """返回 (要导出的 cohort 列表, 是否加 cohort 列)"""
+    if (request.args.get("cohort") or "").strip() == COHORT_ALL:
+        return STORAGE.cohorts(), True
+    return [current_cohort()], False
+
+
+def iter_export_rows(table_name: str, cohorts, with_cohort_col: bool):
+    """先 yield 表头，再逐行 yield；每个 cohort 读完才读下一个，不会同时打开全部分库"""
+    header_sent = False
+    for c in cohorts:
+        rows = STORAGE.iter_table(c, table_name)
+        cols = next(rows)
+        if not header_sent:
+            yield (["cohort"] + cols) if with_cohort_col else cols
+            header_sent = True
+
+        label = c or COHORT_DEFAULT
+        for r in rows:
+            yield ([label] + r) if with_cohort_col else r
 
 
 # -------------------------
 # Export: single table (CSV)
 #   /_export/survey_t1?token=xxx
+#   /_export/survey_t1?token=xxx&cohort=all
 # -------------------------
 @app.route("/_export/<table_name>")
 def export_table(table_name):
@@ -816,46 +2743,22 @@ def export_table(table_name):
     if denied:
         return denied
 
-    ALLOWED = {
-        "participants",
-        "condition_assign",
-        "baseline",
-        "material_choice",
-        "planning_input",
-        "survey_t1",
-        "survey_t2",
-        "chat_log",
-    }
-    if table_name not in ALLOWED:
+    if table_name not in EXPORT_TABLES:
         return "Table not allowed", 403
 
-    def generate_csv():
-        conn = db_conn()
-        cur = conn.cursor()
-        cur.execute(f"SELECT * FROM {table_name}")
-        cols = [d[0] for d in cur.description]
+    cohorts, with_cohort_col = export_cohorts()
 
+    def generate_csv():
         output = io.StringIO()
         writer = csv.writer(output)
 
         # Excel 友好：BOM
         yield "\ufeff"
-        writer.writerow(cols)
-        yield output.getvalue()
-        output.seek(0)
-        output.truncate(0)
-
-        while True:
-            rows = cur.fetchmany(2000)
-            if not rows:
-                break
-            for r in rows:
-                writer.writerow(list(r))
-                yield output.getvalue()
-                output.seek(0)
-                output.truncate(0)
-
-        conn.close()
+        for row in iter_export_rows(table_name, cohorts, with_cohort_col):
+            writer.writerow(row)
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
 
     return Response(
         generate_csv(),
@@ -867,6 +2770,7 @@ def export_table(table_name):
 # -------------------------
 # Export: all tables as ZIP
 #   /_export_all?token=xxx
+#   /_export_all?token=xxx&cohort=all
 # -------------------------
 @app.route("/_export_all")
 def export_all_tables_zip():
@@ -874,46 +2778,22 @@ def export_all_tables_zip():
     if denied:
         return denied
 
-    tables = [
-        "participants",
-        "condition_assign",
-        "baseline",
-        "material_choice",
-        "planning_input",
-        "chat_log",
-        "survey_t1",
-        "survey_t2",
-    ]
-
-    def table_to_csv_bytes(conn, table_name: str) -> bytes:
-        cur = conn.cursor()
-        cur.execute(f"SELECT * FROM {table_name}")
-        cols = [d[0] for d in cur.description]
+    cohorts, with_cohort_col = export_cohorts()
 
+    def table_to_csv_bytes(table_name: str) -> bytes:
         s = io.StringIO()
         w = csv.writer(s)
-        w.writerow(cols)
-
-        while True:
-            rows = cur.fetchmany(2000)
-            if not rows:
-                break
-            for r in rows:
-                w.writerow(list(r))
-
+        for row in iter_export_rows(table_name, cohorts, with_cohort_col):
+            w.writerow(row)
         return s.getvalue().encode("utf-8-sig")
 
-    conn = db_conn()
     mem_zip = io.BytesIO()
-    try:
-        with zipfile.ZipFile(mem_zip, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-            for t in tables:
-                try:
-                    zf.writestr(f"{t}.csv", table_to_csv_bytes(conn, t))
-                except Exception as e:
-                    zf.writestr(f"{t}__ERROR.txt", f"{type(e).__name__}: {str(e)}\n".encode("utf-8"))
-    finally:
-        conn.close()
+    with zipfile.ZipFile(mem_zip, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for t in EXPORT_TABLES:
+            try:
+                zf.writestr(f"{t}.csv", table_to_csv_bytes(t))
+            except Exception as e:
+                zf.writestr(f"{t}__ERROR.txt", f"{type(e).__name__}: {str(e)}\n".encode("utf-8"))
 
     mem_zip.seek(0)
     return Response(
@@ -923,8 +2803,88 @@ def export_all_tables_zip():
     )
 
 
+# -------------------------
+# Static manifest（静态文件带内容指纹：/static/x.jpg?v=<hash>，可以长缓存）
+# -------------------------
+STATIC_MANIFEST = {}
+_STATIC_MANIFEST_READY = False
+
+
+def build_static_manifest():
+    global _STATIC_MANIFEST_READY
+    manifest = {}
+    for root, _, files in os.walk(app.static_folder):
+        for fn in files:
+            path = os.path.join(root, fn)
+            rel = os.path.relpath(path, app.static_folder).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                manifest[rel] = hashlib.md5(f.read()).hexdigest()[:10]
+    STATIC_MANIFEST.clear()
+    STATIC_MANIFEST.update(manifest)
+    _STATIC_MANIFEST_READY = True
+
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    if endpoint != "static" or "v" in values:
+        return
+    if not _STATIC_MANIFEST_READY:
+        build_static_manifest()
+    v = STATIC_MANIFEST.get(values.get("filename"))
+    if v:
+        values["v"] = v
+
+
+@app.after_request
+def cache_versioned_static(resp):
+    # 带了正确指纹的静态文件：内容变了 URL 就变，可以放心缓存一年
+    if request.endpoint == "static" and resp.status_code == 200:
+        v = request.args.get("v")
+        if v and v == STATIC_MANIFEST.get((request.view_args or {}).get("filename")):
+            resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
 
 
-
-
-
+# -------------------------
+# App factory（gunicorn --preload 安全）
+#   gunicorn -c gunicorn.conf.py        → wsgi_app = "app:create_app()"，preload_app = True
+#   master 里跑一次 create_app()：建表检查、模板编译、静态 manifest、回复模板都在 fork 前做好，
+#   worker 以 copy-on-write 共享；数据库连接 / 连接池 / 后台线程一律在 worker 里第一次用到时才建。
+#   旧的 gunicorn app:app 也能跑，只是这些工作推迟到各 worker 第一次请求时。
+# -------------------------
+STARTUP_STATS = {
+    "init_pid": None,        # 跑 create_app() 的进程（preload 时是 master）
+    "app_init_ms": None,
+    "worker_pid": None,
+    "worker_boot_ms": None,  # fork → worker 可以接请求（gunicorn.conf.py 里量）
+    "preloaded": False,
+}
+_APP_READY = False
+
+
+def create_app():
+    global _APP_READY
+    if _APP_READY:
+        return app
+
+    t0 = time.perf_counter()
+    STORAGE.prepare()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    build_static_manifest()
+
+    STARTUP_STATS["init_pid"] = os.getpid()
+    STARTUP_STATS["app_init_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    _APP_READY = True
+    return app
+
+
+def record_worker_startup(boot_ms: float):
+    STARTUP_STATS["worker_pid"] = os.getpid()
+    STARTUP_STATS["worker_boot_ms"] = round(boot_ms, 1)
+    STARTUP_STATS["preloaded"] = STARTUP_STATS["init_pid"] not in (None, os.getpid())
+
+
+@app.route("/_debug/startup")
+def debug_startup():
+    return jsonify({**STARTUP_STATS, "pid": os.getpid()})
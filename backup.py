@@ -0,0 +1,459 @@
+"""
+持续增量备份：把 SQLite WAL 里已提交的帧（整页镜像）不断复制到本地备份目录。
+
+目录结构（每个库文件一个子目录，例如 experiment / cohort_2025A）：
+
+    BACKUP_DIR/<db>/<generation>/snapshot.db.gz     该代开始时的整库快照（逐页复制）
+    BACKUP_DIR/<db>/<generation>/wal/<seq>.seg.gz   之后每一轮新提交的 WAL 帧
+
+- generation（代）= 一个快照 + 其后的连续帧。定期开新代（即压缩后的快照），旧代按数量清理。
+- 复制线程只读 WAL 文件 + 用一个读事务钉住快照，不拿写锁，参与者的写请求不会被它挡住。
+- 只有复制线程做 checkpoint（其余连接的 wal_autocheckpoint 调得很大，只当安全阀）；
+  如果 WAL 在没复制完的情况下被别人重置（或两轮之间被重置了不止一次），就自动开新代，不会出现缺帧的备份。
+
+时间点恢复：
+
+    python backup.py list    --dir /data/backup
+    python backup.py restore --dir /data/backup --db experiment --to 2025-03-01T10:00:00 --out /tmp/restored.db
+"""
+import argparse, fcntl, gzip, json, os, shutil, sqlite3, struct, sys, threading, time, traceback, uuid
+from datetime import datetime
+
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+WAL_MAGIC_LE = 0x377F0682
+WAL_MAGIC_BE = 0x377F0683
+
+SEGMENT_MAGIC = b"EXPWALSEG1\n"
+
+
+# -------------------------
+# WAL 解析
+# -------------------------
+def wal_checksum(data: bytes, s1: int, s2: int, big_endian: bool):
+    n = len(data) // 4
+    words = struct.unpack(("%s%dI" % (">" if big_endian else "<", n)), data)
+    for i in range(0, n, 2):
+        s1 = (s1 + words[i] + s2) & 0xFFFFFFFF
+        s2 = (s2 + words[i + 1] + s1) & 0xFFFFFFFF
+    return s1, s2
+
+
+def read_wal_header(f):
+    f.seek(0)
+    raw = f.read(WAL_HEADER_SIZE)
+    if len(raw) < WAL_HEADER_SIZE:
+        return None
+    magic, version, page_size, ckpt_seq, salt1, salt2, c1, c2 = struct.unpack(">8I", raw)
+    if magic not in (WAL_MAGIC_LE, WAL_MAGIC_BE):
+        return None
+    big = (magic == WAL_MAGIC_BE)
+    if wal_checksum(raw[:24], 0, 0, big) != (c1, c2):
+        return None
+    return {"page_size": page_size, "salt": (salt1, salt2), "big": big, "cksum": (c1, c2), "ckpt_seq": ckpt_seq}
+
+
+def is_next_wal(prev_salt, header) -> bool:
+    """
+    header 是不是 prev_salt 那份 WAL 之后“紧接着”的一份（只重置了一次）。
+    每次重置 salt1 都 +1（共享的 wal-index 头里递增）；ckpt_seq 是各连接自己的计数，多连接时不可靠，不用。
+    """
+    return prev_salt is not None and header["salt"][0] == (prev_salt[0] + 1) & 0xFFFFFFFF
+
+
+def read_committed_frames(f, header, offset: int, cksum, max_frames: int = None):
+    """
+    从 offset 开始读帧，校验 salt + 累计校验和；只返回到最后一个提交帧为止（max_frames=None 不限）。
+    返回 (frames, new_offset, new_cksum)；frames = [(pgno, commit_size, page_bytes), ...]
+    """
+    page_size = header["page_size"]
+    frame_size = WAL_FRAME_HEADER_SIZE + page_size
+    f.seek(offset)
+
+    pending, committed = [], []
+    pos, s = offset, cksum
+    committed_pos, committed_cksum = offset, cksum
+
+    while max_frames is None or len(committed) + len(pending) < max_frames:
+        raw = f.read(frame_size)
+        if len(raw) < frame_size:
+            break
+        pgno, commit, salt1, salt2, c1, c2 = struct.unpack(">6I", raw[:WAL_FRAME_HEADER_SIZE])
+        if (salt1, salt2) != header["salt"]:
+            break
+        s = wal_checksum(raw[:8], s[0], s[1], header["big"])
+        s = wal_checksum(raw[WAL_FRAME_HEADER_SIZE:], s[0], s[1], header["big"])
+        if s != (c1, c2):
+            break
+
+        pending.append((pgno, commit, raw[WAL_FRAME_HEADER_SIZE:]))
+        pos += frame_size
+        if commit:
+            committed.extend(pending)
+            pending = []
+            committed_pos, committed_cksum = pos, s
+
+    return committed, committed_pos, committed_cksum
+
+
+# -------------------------
+# 备份文件格式
+# -------------------------
+def write_segment(path: str, frames, page_size: int, ts: str):
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wb", compresslevel=3) as out:
+        out.write(SEGMENT_MAGIC)
+        out.write(json.dumps({"ts": ts, "page_size": page_size, "frames": len(frames)}).encode() + b"\n")
+        for pgno, commit, page in frames:
+            out.write(struct.pack(">II", pgno, commit))
+            out.write(page)
+    os.replace(tmp, path)
+
+
+def read_segment(path: str):
+    with gzip.open(path, "rb") as f:
+        if f.readline() != SEGMENT_MAGIC:
+            raise ValueError(f"not a WAL segment: {path}")
+        meta = json.loads(f.readline())
+        page_size = meta["page_size"]
+        frames = []
+        for _ in range(meta["frames"]):
+            pgno, commit = struct.unpack(">II", f.read(8))
+            frames.append((pgno, commit, f.read(page_size)))
+    return meta, frames
+
+
+def db_backup_name(db_path: str) -> str:
+    name = os.path.basename(db_path)
+    return name[:-3] if name.endswith(".db") else name
+
+
+# -------------------------
+# 复制线程
+# -------------------------
+class _DBState:
+    def __init__(self):
+        self.generation = None
+        self.gen_started = 0.0
+        self.seq = 0
+        self.salt = None
+        self.offset = WAL_HEADER_SIZE
+        self.cksum = None
+        self.page_size = None
+        # 上一次 checkpoint 已经把全部帧写回、且这些帧都已复制 → WAL 被重置也不会丢帧
+        self.safe_to_reset = False
+        self.last_shipped_at = None
+        self.frames_shipped = 0
+
+
+class Replicator:
+    def __init__(self, backup_dir: str, list_db_paths, interval_sec: float = 10.0,
+                 snapshot_every_sec: float = 3600.0, keep_generations: int = 24,
+                 max_frames_per_cycle: int = 20000):
+        self.backup_dir = backup_dir
+        self.list_db_paths = list_db_paths
+        self.interval_sec = interval_sec
+        self.snapshot_every_sec = snapshot_every_sec
+        self.keep_generations = keep_generations
+        self.max_frames_per_cycle = max_frames_per_cycle
+
+        self.states = {}
+        self._conns = {}
+        self._lock_file = None
+        self.is_leader = False
+        self.last_error = None
+
+    # --- 多 worker 只允许一个复制者 ---
+    def _try_lead(self) -> bool:
+        if self.is_leader:
+            return True
+        os.makedirs(self.backup_dir, exist_ok=True)
+        f = open(os.path.join(self.backup_dir, ".replicator.lock"), "a+")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._lock_file = f
+        self.is_leader = True
+        return True
+
+    def _conn(self, db_path: str):
+        # 复制者自己的两条长连接（读 / checkpoint）：一直开着，也避免“最后一个连接关闭时自动 checkpoint”
+        conns = self._conns.get(db_path)
+        if conns is None:
+            conns = []
+            for _ in range(2):
+                conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode = WAL;")
+                conns.append(conn)
+            self._conns[db_path] = conns
+        return conns
+
+    def run_forever(self):
+        while True:
+            started = time.time()
+            try:
+                if self._try_lead():
+                    self.run_once()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                traceback.print_exc()
+            # 本轮超时就直接进下一轮，不排队补跑
+            time.sleep(max(0.5, self.interval_sec - (time.time() - started)))
+
+    def run_once(self):
+        for db_path in self.list_db_paths():
+            if os.path.exists(db_path):
+                self.replicate(db_path)
+
+    def status(self):
+        return {
+            "leader": self.is_leader,
+            "last_error": self.last_error,
+            "databases": {
+                db_backup_name(p): {
+                    "generation": s.generation,
+                    "segments": s.seq,
+                    "frames_shipped": s.frames_shipped,
+                    "last_shipped_at": s.last_shipped_at,
+                }
+                for p, s in self.states.items()
+            },
+        }
+
+    # --- 一个库的一轮复制 ---
+    def replicate(self, db_path: str):
+        state = self.states.setdefault(db_path, _DBState())
+        reader, checkpointer = self._conn(db_path)
+        wal_path = db_path + "-wal"
+
+        reason = None
+        if state.generation is None:
+            reason = "start"
+        elif time.time() - state.gen_started >= self.snapshot_every_sec:
+            reason = "scheduled"
+
+        # 读事务钉住当前快照：持有期间 WAL 不会被重置，checkpoint 也写不过这个位置
+        reader.execute("BEGIN;")
+        try:
+            reader.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()
+
+            header = None
+            if os.path.exists(wal_path):
+                with open(wal_path, "rb") as f:
+                    header = read_wal_header(f)
+
+            if reason is None and header is not None and header["salt"] != state.salt:
+                if not (state.safe_to_reset and is_next_wal(state.salt, header)):
+                    # WAL 被别人重置，中间可能有没复制的帧 → 开新代：
+                    #   上次 checkpoint 没把已复制的帧全部写回；或两轮之间重置了不止一次（salt1 跳了不止 1，
+                    #   中间那份 WAL 的帧已经没了）；或开这一代时还没有 WAL，无从确认新 WAL 之前没被重置过
+                    reason = "wal_reset"
+                else:
+                    state.salt = header["salt"]
+                    state.offset = WAL_HEADER_SIZE
+                    state.cksum = header["cksum"]
+                    state.page_size = header["page_size"]
+
+            if reason is not None:
+                self._start_generation(db_path, reader, state, header, reason)
+            elif header is not None:
+                self._ship_frames(db_path, wal_path, state, header, self.max_frames_per_cycle)
+
+            # 只有复制者做 checkpoint，而且是在读事务还钉着的时候做：
+            # 写回最多到读事务的快照位置（都已复制），没写回完 WAL 就不会被重置
+            busy, log_frames, ckpt_frames = checkpointer.execute("PRAGMA wal_checkpoint(PASSIVE);").fetchone()
+            if state.page_size:
+                shipped_frames = (state.offset - WAL_HEADER_SIZE) // (WAL_FRAME_HEADER_SIZE + state.page_size)
+                state.safe_to_reset = (not busy and log_frames >= 0
+                                       and log_frames == ckpt_frames == shipped_frames)
+        finally:
+            reader.execute("COMMIT;")
+
+    def _start_generation(self, db_path, reader, state, header, reason):
+        """逐页快照（backup API，在当前读事务里），然后从当前 WAL 开头开始复制帧"""
+        name = db_backup_name(db_path)
+        gen = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ") + "-" + uuid.uuid4().hex[:6]
+        gen_dir = os.path.join(self.backup_dir, name, gen)
+        os.makedirs(os.path.join(gen_dir, "wal"), exist_ok=True)
+
+        tmp_db = os.path.join(gen_dir, ".snapshot.db")
+        dst = sqlite3.connect(tmp_db)
+        try:
+            reader.backup(dst)
+        finally:
+            dst.close()
+        with open(tmp_db, "rb") as src, gzip.open(os.path.join(gen_dir, "snapshot.db.gz"), "wb", compresslevel=3) as out:
+            shutil.copyfileobj(src, out, 1024 * 1024)
+        os.remove(tmp_db)
+
+        ts = datetime.utcnow().isoformat()
+        with open(os.path.join(gen_dir, "generation.json"), "w") as f:
+            json.dump({"generation": gen, "snapshot_at": ts, "db": name, "reason": reason}, f)
+
+        state.generation = gen
+        state.gen_started = time.time()
+        state.seq = 0
+        state.safe_to_reset = False
+        state.last_shipped_at = ts
+
+        # 快照已包含当前 WAL 里读事务可见的全部帧；从 WAL 开头重放是幂等的（整页镜像，按顺序覆盖）。
+        # 但只重放一部分会把快照里的页盖回更早的版本 → 第一段不限帧数，一次带上快照之前的全部帧：
+        # 恢复时要么停在第一段之前（只用快照），要么整段重放（不早于快照）
+        if header is not None:
+            state.salt = header["salt"]
+            state.offset = WAL_HEADER_SIZE
+            state.cksum = header["cksum"]
+            state.page_size = header["page_size"]
+            self._ship_frames(db_path, db_path + "-wal", state, header, None)
+        else:
+            state.salt = None
+
+        self._prune(name)
+
+    def _ship_frames(self, db_path, wal_path, state, header, max_frames):
+        with open(wal_path, "rb") as f:
+            frames, offset, cksum = read_committed_frames(f, header, state.offset, state.cksum, max_frames)
+        if not frames:
+            return
+
+        ts = datetime.utcnow().isoformat()
+        gen_dir = os.path.join(self.backup_dir, db_backup_name(db_path), state.generation)
+        state.seq += 1
+        write_segment(os.path.join(gen_dir, "wal", f"{state.seq:08d}.seg.gz"), frames, header["page_size"], ts)
+
+        state.offset, state.cksum = offset, cksum
+        state.frames_shipped += len(frames)
+        state.last_shipped_at = ts
+
+    def _prune(self, name: str):
+        gens = list_generations(self.backup_dir, name)
+        for g in gens[:-self.keep_generations] if self.keep_generations > 0 else []:
+            shutil.rmtree(os.path.join(self.backup_dir, name, g["generation"]), ignore_errors=True)
+
+
+_REPLICATOR = None
+_REPLICATOR_PID = None
+_REPLICATOR_LOCK = threading.Lock()
+
+
+def start_replicator(backup_dir: str, list_db_paths, **kwargs):
+    """每个进程最多起一个复制线程（fork 之后重新起）；多个进程之间靠文件锁选出一个干活"""
+    global _REPLICATOR, _REPLICATOR_PID
+    with _REPLICATOR_LOCK:
+        if _REPLICATOR is not None and _REPLICATOR_PID == os.getpid():
+            return _REPLICATOR
+        _REPLICATOR = Replicator(backup_dir, list_db_paths, **kwargs)
+        _REPLICATOR_PID = os.getpid()
+        threading.Thread(target=_REPLICATOR.run_forever, name="wal-replicator", daemon=True).start()
+        return _REPLICATOR
+
+
+def replicator_status():
+    if _REPLICATOR is None or _REPLICATOR_PID != os.getpid():
+        return None
+    return _REPLICATOR.status()
+
+
+# -------------------------
+# 恢复
+# -------------------------
+def list_generations(backup_dir: str, name: str):
+    root = os.path.join(backup_dir, name)
+    out = []
+    if not os.path.isdir(root):
+        return out
+    for gen in sorted(os.listdir(root)):
+        meta_path = os.path.join(root, gen, "generation.json")
+        if not os.path.exists(meta_path):
+            continue
+        with open(meta_path) as f:
+            meta = json.load(f)
+        segs = sorted(os.listdir(os.path.join(root, gen, "wal")))
+        segs = [s for s in segs if s.endswith(".seg.gz")]
+        meta["segments"] = segs
+        out.append(meta)
+    # 目录名只精确到秒（+ 随机后缀），同一秒里开的两代要按快照时间排
+    out.sort(key=lambda g: g["snapshot_at"])
+    return out
+
+
+def restore(backup_dir: str, name: str, out_path: str, to: datetime = None):
+    """
+    恢复到 to（UTC）之前最后一个完整复制点；to=None 恢复到最新。
+    选 snapshot_at <= to 的最新一代，解压快照后按顺序重放该代的 WAL 段。
+    """
+    gens = list_generations(backup_dir, name)
+    if to is not None:
+        gens = [g for g in gens if datetime.fromisoformat(g["snapshot_at"]) <= to]
+    if not gens:
+        raise SystemExit(f"no backup generation for {name!r} at or before {to}")
+    gen = gens[-1]
+    gen_dir = os.path.join(backup_dir, name, gen["generation"])
+
+    tmp = out_path + ".restoring"
+    with gzip.open(os.path.join(gen_dir, "snapshot.db.gz"), "rb") as src, open(tmp, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    applied_until = gen["snapshot_at"]
+    with open(tmp, "r+b") as db:
+        for seg in gen["segments"]:
+            meta, frames = read_segment(os.path.join(gen_dir, "wal", seg))
+            if to is not None and datetime.fromisoformat(meta["ts"]) > to:
+                break
+            page_size = meta["page_size"]
+            for pgno, commit, page in frames:
+                db.seek((pgno - 1) * page_size)
+                db.write(page)
+                if commit:
+                    db.truncate(commit * page_size)
+            applied_until = meta["ts"]
+
+    # 快照页头里是 WAL 模式；恢复出的文件改回普通 rollback journal，单文件即可直接拷走
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.execute("PRAGMA journal_mode = DELETE;")
+        ok = conn.execute("PRAGMA integrity_check;").fetchone()[0]
+    finally:
+        conn.close()
+    if ok != "ok":
+        raise SystemExit(f"integrity_check failed on restored file: {ok}")
+
+    os.replace(tmp, out_path)
+    return {"generation": gen["generation"], "restored_to": applied_until, "out": out_path}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Inspect and restore WAL backups.")
+    ap.add_argument("--dir", default=os.environ.get("BACKUP_DIR", ""), help="备份目录（默认 $BACKUP_DIR）")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    sub.add_parser("list", help="列出每个库的备份代和复制点")
+
+    r = sub.add_parser("restore", help="时间点恢复")
+    r.add_argument("--db", default="experiment", help="库名（目录名，例如 experiment / cohort_2025A）")
+    r.add_argument("--to", default=None, help="恢复到这个 UTC 时间（ISO 8601）；不填 = 最新")
+    r.add_argument("--out", required=True, help="输出文件")
+
+    args = ap.parse_args(argv)
+    if not args.dir:
+        ap.error("--dir or $BACKUP_DIR is required")
+
+    if args.cmd == "list":
+        for name in sorted(os.listdir(args.dir)):
+            if name.startswith("."):
+                continue
+            print(name)
+            for g in list_generations(args.dir, name):
+                print(f"  {g['generation']}  snapshot_at={g['snapshot_at']}  segments={len(g['segments'])}"
+                      f"  ({g.get('reason', '')})")
+        return
+
+    to = datetime.fromisoformat(args.to) if args.to else None
+    print(json.dumps(restore(args.dir, args.db, args.out, to), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
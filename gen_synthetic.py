@@ -0,0 +1,292 @@
+"""
+批量生成合成参与者数据，用来压测 schema / 索引 / 导出 / 分组配额。
+
+    python gen_synthetic.py --db /tmp/scale.db --scales 10000,50000,100000
+    python gen_synthetic.py --db /tmp/scale_compact.db --format compact   # 和上面对比体积 / 扫描速度
+
+每个规模点：先把库补到 N 个参与者（已有的不重复生成），再测一遍主要路由用到的查询耗时。
+对话内容直接用 app.generate_assistant_reply 的真实脚本生成。
+"""
+import argparse, math, os, random, statistics, sys, time, uuid
+from datetime import datetime, timedelta
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Bulk-load synthetic participants and time the main queries.")
+    ap.add_argument("--db", default=os.environ.get("DB_PATH", "/data/experiment.db"),
+                    help="目标 SQLite 文件（默认 $DB_PATH）")
+    ap.add_argument("--scales", default="10000,50000,100000",
+                    help="逗号分隔的参与者总数，逐级补齐并测量")
+    ap.add_argument("--batch", type=int, default=2000, help="每个事务写入的参与者数")
+    ap.add_argument("--min-turns", type=int, default=10)
+    ap.add_argument("--max-turns", type=int, default=20)
+    ap.add_argument("--t2-ratio", type=float, default=0.8, help="完成 T2 的比例")
+    ap.add_argument("--samples", type=int, default=200, help="每个查询的采样次数")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--format", choices=["text", "compact"], default=None,
+                    help="新建库时的存储格式（默认 $STORAGE_FORMAT / text；已有的库保持原格式）")
+    return ap.parse_args()
+
+
+# main() 里赋值：命令行参数，和按参数设好环境变量之后才 import 的 app
+ARGS = None
+A = None
+
+
+def load_app(args):
+    # app 在 import 时读取 DB_PATH，必须先设好
+    os.environ["DB_PATH"] = os.path.abspath(args.db)
+    os.environ.setdefault("RATELIMIT_ENABLED", "0")
+    if args.format:
+        os.environ["STORAGE_FORMAT"] = args.format
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    return app
+
+
+MATERIALS = [
+    ("bronze", "青铜纹样"),
+    ("chibi_drum", "鼓乐/乐舞"),
+    ("chu_ritual", "楚礼仪/祭祀"),
+    ("han_embroidery", "汉绣/刺绣"),
+    ("lianghu_literature", "两湖文学意象"),
+    ("qianjiang_woodcarving", "潜江木雕"),
+    ("tujia_brocade", "土家织锦"),
+    ("yangxin_applique", "阳新布贴"),
+]
+
+GRADES = ["大一-设计", "大二-设计", "大三-数媒", "大二-中文", "研一-艺术学"]
+
+USER_TEXTS = {
+    1: ["载体", "文化元素", "故事氛围", "符号颜色"],
+    2: ["纹样好看，有辨识度", "想做点不一样的", "小时候见过，有感情"],
+    3: ["海报", "包装", "导视", "交互界面", "短视频封面"],
+    4: ["同龄大学生，校园文化节", "游客，博物馆文创店", "亲子家庭，周末展览"],
+    5: ["纹样", "器物", "工艺", "仪式", "故事"],
+    6: ["神秘、克制", "热烈、传统", "质朴、现代", "精致、克制"],
+    7: ["图形符号", "故事画面"],
+    8: ["把青铜纹样变成潮流贴纸", "把织锦变成手机壳", "把鼓乐变成动态海报"],
+    9: ["现代极简", "传统丰富"],
+}
+FALLBACK_TEXTS = [
+    "我觉得核心信息还不够清楚", "想先改形式呈现", "担心被理解成纯装饰",
+    "材质、红黑配色、几何纹样", "参考故宫文创和一些独立品牌", "清晰度 5 分，还需要草图验证",
+    "下一步先画两版构图", "保留纹样本身不变", "内容表达",
+]
+
+SAMPLE_PIDS = 500
+
+
+def iso(dt):
+    return dt.isoformat()
+
+
+def balanced_cells(rng, n):
+    """按 4 个一组打乱，保证各组人数平衡（和线上配额效果一致）"""
+    out = []
+    while len(out) < n:
+        block = list(A.CONDITION_CELLS)
+        rng.shuffle(block)
+        out.extend(block)
+    return out[:n]
+
+
+def build_batch(rng, n, now, fmt, ua):
+    rows = {k: [] for k in (
+        "participants", "baseline", "material_choice", "condition_assign",
+        "planning_input", "chat_log", "survey_t1", "survey_t2",
+    )}
+
+    for planning, feedback in balanced_cells(rng, n):
+        pid = str(uuid.uuid4())
+        t0 = now - timedelta(days=rng.uniform(0, 60), seconds=rng.uniform(0, 86400))
+        rows["participants"].append((pid, iso(t0), iso(t0)))
+        rows["baseline"].append((
+            pid, rng.choice(GRADES), str(rng.randint(1, 5)), str(rng.randint(1, 5)),
+            str(rng.randint(1, 7)), iso(t0 + timedelta(seconds=40)),
+        ))
+
+        key, label = rng.choice(MATERIALS)
+        rt_ms = rng.randint(1500, 30000)
+        rows["material_choice"].append((
+            pid, key, label, iso(t0 + timedelta(seconds=60)),
+            iso(t0 + timedelta(seconds=60, milliseconds=rt_ms)), rt_ms,
+            ua,
+        ))
+        rows["condition_assign"].append((pid, planning, feedback, iso(t0 + timedelta(seconds=90))))
+
+        if planning == "pre":
+            rows["planning_input"].append((
+                pid, "让同学了解本地非遗", "校园展览", "纹样+色彩", "海报",
+                iso(t0 + timedelta(seconds=200)),
+            ))
+
+        # 对话：真实的回复脚本；session 里的 chat_mem 逐个参与者清空
+        A.session.pop("chat_mem", None)
+        t_chat = t0 + timedelta(seconds=300)
+        for turn in range(1, rng.randint(ARGS.min_turns, ARGS.max_turns) + 1):
+            t_chat += timedelta(seconds=rng.uniform(10, 90))
+            text = rng.choice(USER_TEXTS.get(turn) or FALLBACK_TEXTS)
+            reply = A.generate_assistant_reply(planning, feedback, text, turn_id=turn)
+            rows["chat_log"].append(A.chat_row_params(fmt, pid, turn, "user", text, t_chat))
+            rows["chat_log"].append(A.chat_row_params(fmt, pid, turn, "assistant", reply, t_chat))
+
+        t1_at = t_chat + timedelta(minutes=3)
+        rows["survey_t1"].append((
+            pid, *[rng.randint(1, 7) for _ in range(19)], iso(t1_at), iso(A.compute_t2_eligible_at(t1_at)),
+        ))
+
+        if rng.random() < ARGS.t2_ratio:
+            t2_at = t1_at + timedelta(days=A.T2_DELAY_DAYS, hours=rng.uniform(0, 72))
+            rows["survey_t2"].append((pid, *[rng.randint(1, 7) for _ in range(10)], iso(t2_at)))
+
+    return rows
+
+
+def insert_sqls():
+    return {
+        "participants": "INSERT INTO participants(participant_id, consent_time, created_at) VALUES (?,?,?)",
+        "baseline": """INSERT INTO baseline(participant_id, grade_major, culture_course, chatbot_exp, stress_1w, created_at)
+                       VALUES (?,?,?,?,?,?)""",
+        "material_choice": """INSERT INTO material_choice
+                       (participant_id, chosen_direction, chosen_label, page_time, choice_time, rt_ms, {ua_col})
+                       VALUES (?,?,?,?,?,?,?)""",
+        "condition_assign": """INSERT INTO condition_assign(participant_id, condition_planning, condition_feedback, assigned_at)
+                       VALUES (?,?,?,?)""",
+        "planning_input": """INSERT INTO planning_input(participant_id, plan_goal, plan_audience_context, plan_elements,
+                       plan_output, created_at) VALUES (?,?,?,?,?,?)""",
+        "chat_log": A.CHAT_INSERT_SQL,
+        # 问卷直接用 app 里由 INSTRUMENTS 生成的 upsert（列顺序：pid, 题目…, created_at, 服务端列…）
+        "survey_t1": A.INSTRUMENTS["t1"].upsert_sql,
+        "survey_t2": A.INSTRUMENTS["t2"].upsert_sql,
+    }
+
+
+def load_up_to(rng, target):
+    conn = A.db_conn("")
+    have = conn.execute("SELECT COUNT(*) FROM participants").fetchone()[0]
+    todo = max(0, target - have)
+    now = datetime.utcnow()
+    t_start = time.perf_counter()
+
+    fmt = conn.storage_format
+    ua_raw = "Mozilla/5.0 (synthetic)"
+    ua = A.user_agent_id(conn, ua_raw) if fmt == "compact" else ua_raw
+    conn.commit()
+    ua_col = "ua_id" if fmt == "compact" else "user_agent"
+    inserts = insert_sqls()
+
+    # 大事务 + executemany；synchronous 只对本连接生效
+    conn.execute("PRAGMA synchronous = OFF;")
+    with A.app.test_request_context():
+        while todo > 0:
+            n = min(ARGS.batch, todo)
+            rows = build_batch(rng, n, now, fmt, ua)
+            conn.execute("BEGIN;")
+            for table, sql in inserts.items():
+                conn.executemany(sql.format(ua_col=ua_col), rows[table])
+            conn.commit()
+            todo -= n
+            have += n
+            if sys.stdout.isatty():
+                print(f"  loaded {have:>8} participants", end="\r", flush=True)
+
+    conn.execute("ANALYZE;")
+    conn.close()
+    print(f"  loaded {have:>8} participants in {time.perf_counter() - t_start:.1f}s")
+
+
+def timed(fn, samples):
+    out = []
+    for _ in range(samples):
+        t = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t) * 1000)
+    out.sort()
+    return statistics.median(out), out[max(0, math.ceil(len(out) * 0.95) - 1)]
+
+
+def benchmark(rng):
+    conn = A.db_conn("")
+    pids = [r[0] for r in conn.execute(
+        "SELECT participant_id FROM participants ORDER BY random() LIMIT ?", (SAMPLE_PIDS,)
+    )]
+    pick = lambda: rng.choice(pids)  # noqa: E731
+
+    fmt = conn.storage_format
+
+    def chat_insert():
+        pid = pick()
+        conn.execute("BEGIN;")
+        conn.execute(A.CHAT_INSERT_SQL, A.chat_row_params(fmt, pid, 99, "user", "bench", datetime.utcnow()))
+        conn.execute(A.CHAT_INSERT_SQL, A.chat_row_params(fmt, pid, 99, "assistant", "bench", datetime.utcnow()))
+        conn.rollback()
+
+    def scan_chat_raw():
+        # 纯扫描（不解码）：体现行宽 / 页数的差别
+        conn.execute("SELECT COUNT(*), SUM(length(text)), MAX(ts) FROM chat_log").fetchone()
+
+    def t2_reminders():
+        start = datetime.utcnow() - timedelta(days=rng.uniform(0, 60))
+        A.list_t2_eligible_between(start, start + timedelta(days=1))
+
+    def debug_counts():
+        for t in A.EXPORT_TABLES:
+            conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()
+
+    cases = [
+        ("quota counts (assign)", lambda: A.count_condition_cells(conn.cursor()), ARGS.samples),
+        ("chat: count user turns", lambda: A.count_user_turns(conn, pick()), ARGS.samples),
+        ("chat: insert turn pair", chat_insert, ARGS.samples),
+        ("t2 eligibility", lambda: A.get_t2_eligibility(pick()), ARGS.samples),
+        ("t2 reminders (1-day window)", t2_reminders, ARGS.samples),
+        ("debug counts", debug_counts, max(1, ARGS.samples // 20)),
+        ("scan chat_log (raw)", scan_chat_raw, 5),
+    ]
+
+    results = [(name, *timed(fn, n)) for name, fn, n in cases]
+
+    # 各表 + 索引占用（需要 SQLite 编译了 dbstat）
+    try:
+        sizes = conn.execute("""
+          SELECT name, SUM(pgsize) AS bytes FROM dbstat
+          WHERE name LIKE 'chat_%' OR name LIKE 'idx_chat_%' OR name LIKE 'material_%' OR name = 'user_agents'
+          GROUP BY name ORDER BY bytes DESC
+        """).fetchall()
+    except Exception:
+        sizes = []
+    conn.close()
+
+    t = time.perf_counter()
+    n_rows = sum(1 for _ in A.iter_export_rows("chat_log", [""], False))
+    export_ms = (time.perf_counter() - t) * 1000
+
+    return fmt, results, sizes, (n_rows - 1, export_ms)
+
+
+def main():
+    global ARGS, A
+    ARGS = parse_args()
+    A = load_app(ARGS)
+
+    rng = random.Random(ARGS.seed)
+    scales = [int(x) for x in ARGS.scales.split(",") if x.strip()]
+    print(f"DB: {os.environ['DB_PATH']}")
+
+    for target in sorted(scales):
+        print(f"\n=== scale {target} participants ===")
+        load_up_to(rng, target)
+        fmt, results, sizes, (n_rows, export_ms) = benchmark(rng)
+
+        size_mb = os.path.getsize(os.environ["DB_PATH"]) / 1024 / 1024
+        print(f"  db size: {size_mb:.1f} MB  (storage format: {fmt})")
+        for name, nbytes in sizes:
+            print(f"    {name:<34}{nbytes / 1024 / 1024:>8.1f} MB")
+        print(f"  {'query':<30}{'p50 ms':>10}{'p95 ms':>10}")
+        for name, p50, p95 in results:
+            print(f"  {name:<30}{p50:>10.3f}{p95:>10.3f}")
+        print(f"  {'export chat_log (full)':<30}{export_ms:>10.0f} ms for {n_rows} rows")
+
+
+if __name__ == "__main__":
+    main()
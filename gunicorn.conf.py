@@ -0,0 +1,46 @@
+# gunicorn 配置（gunicorn 默认会读当前目录下的 gunicorn.conf.py；启动命令只要 `gunicorn`）
+#
+#   preload_app：master 里 import + create_app() 一次（建表检查、模板编译、静态 manifest），
+#                worker 直接 fork，copy-on-write 共享；重启 / 回收 worker 很便宜
+#   gthread    ：SSE（/_live/stream）一条连接占一个线程，必须用多线程 worker
+import os
+import time
+
+# 直接对外时保持 TRUSTED_PROXIES=0（默认）；放在反向代理后面时设成代理层数，限流才按真实客户端 IP 算
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+wsgi_app = "app:create_app()"
+preload_app = True
+
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
+
+# 定期回收 worker（0 = 不回收）；jitter 让各 worker 错开
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+
+accesslog = "-"
+errorlog = "-"
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        import app as web
+
+        server.log.info("app initialised in %s ms (templates: %s)", web.STARTUP_STATS["app_init_ms"], web.app.template_folder)
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    # worker 启动耗时：fork → 可以接请求（preload 时不含 import / create_app）
+    import app as web
+
+    boot_ms = (time.perf_counter() - worker.forked_at) * 1000
+    web.record_worker_startup(boot_ms)
+    worker.log.info("worker %s ready in %.1f ms (preload=%s)", worker.pid, boot_ms, worker.cfg.preload_app)
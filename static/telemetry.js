@@ -0,0 +1,57 @@
+// 前端过程数据：事件先攒在内存里，每 10 秒 / 满 50 条发一批；页面隐藏或离开时用 sendBeacon 发掉剩下的
+// 用法：
+//   <script src="{{ url_for('static', filename='telemetry.js') }}"
+//           data-page="chat" data-url="{{ url_for('api_telemetry', pid=participant_id) }}"></script>
+//   然后 window.expTelemetry.track("turn_compose", {...})
+(function () {
+  const script = document.currentScript;
+  const url = script.dataset.url;
+  const page = script.dataset.page || "";
+  const FLUSH_MS = 10000;
+  const BATCH_MAX = 50;      // 满这么多条立刻发
+  const QUEUE_MAX = 500;     // 发不出去时最多留这么多，再多丢最旧的
+  // 两批之间至少隔这么久：保证在服务端 telemetry 限流桶（1 次/秒，容量 10）里面，
+  // 离开页面时那次 sendBeacon 看不到响应、没法重试，不能让它撞上 429
+  const MIN_INTERVAL_MS = 2000;
+
+  let queue = [];
+  let lastSent = 0;
+  let pending = null;
+
+  function track(type, data) {
+    queue.push({type: type, page: page, t: Date.now(), data: data || null});
+    if (queue.length > QUEUE_MAX) queue = queue.slice(-QUEUE_MAX);
+    if (queue.length >= BATCH_MAX) flush(false);
+  }
+
+  function flush(leaving) {
+    if (!queue.length || !url) return;
+    const wait = lastSent + MIN_INTERVAL_MS - Date.now();
+    if (!leaving && wait > 0) {
+      if (!pending) pending = setTimeout(function () { pending = null; flush(false); }, wait);
+      return;
+    }
+    lastSent = Date.now();
+    const batch = queue.splice(0, 200);
+    const body = JSON.stringify({events: batch});
+
+    // 离开页面：sendBeacon（字符串 = text/plain，不触发预检），浏览器保证在卸载后发出
+    if (leaving && navigator.sendBeacon && navigator.sendBeacon(url, body)) return;
+
+    fetch(url, {method: "POST", headers: {"Content-Type": "application/json"}, body: body, keepalive: true})
+      .then(function (resp) {
+        // 被限流：放回队列下次再发
+        if (resp.status === 429) queue = batch.concat(queue).slice(-QUEUE_MAX);
+      })
+      .catch(function () {});
+  }
+
+  setInterval(function () { flush(false); }, FLUSH_MS);
+  document.addEventListener("visibilitychange", function () {
+    if (document.visibilityState === "hidden") flush(true);
+  });
+  window.addEventListener("pagehide", function () { flush(true); });
+
+  track("page_view", {path: location.pathname});
+  window.expTelemetry = {track: track, flush: flush};
+})();
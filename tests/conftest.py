@@ -0,0 +1,26 @@
+import os
+import tempfile
+
+import pytest
+
+# app 在 import 时读环境变量定路径 → 必须在第一次 import app 之前设好
+_DATA_DIR = tempfile.mkdtemp(prefix="experiment-tests-")
+os.environ.update(
+    DB_PATH=os.path.join(_DATA_DIR, "experiment.db"),
+    EXPORT_TOKEN="tok",
+    COHORTS="classA,classB,compact1",
+    RATELIMIT_ENABLED="0",
+    LIVE_FEED_ENABLED="0",
+)
+
+
+@pytest.fixture
+def app_module():
+    import app
+    app.app.config["TESTING"] = True
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
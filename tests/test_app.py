@@ -0,0 +1,131 @@
+import csv
+import os
+import sqlite3
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+def test_unknown_cohort_is_rejected_without_creating_a_partition(app_module, client):
+    assert client.get("/chat?pid=zzz&cohort=evil1").status_code == 400
+    assert client.get("/_debug/counts?cohort=evil1").status_code == 400
+    assert client.post("/consent", data={"cohort": "evil1"}).status_code == 400
+    assert not os.path.exists(app_module.cohort_db_path("evil1"))
+    assert "evil1" not in app_module.list_cohorts()
+
+
+def test_consent_creates_allowlisted_cohort(app_module, client):
+    r = client.post("/consent", data={"cohort": "classA"})
+    assert r.status_code == 302
+    assert os.path.exists(app_module.cohort_db_path("classA"))
+    assert client.get("/_debug/counts?cohort=classA").status_code == 200
+
+
+def _consent(client, cohort=""):
+    r = client.post("/consent", data={"cohort": cohort} if cohort else {})
+    assert r.status_code == 302
+    with client.session_transaction() as s:
+        return s["participant_id"]
+
+
+def _export(client, table_name, cohort):
+    r = client.get(f"/_export/{table_name}?token=tok&cohort={cohort}")
+    assert r.status_code == 200
+    return r.data.decode("utf-8-sig").splitlines()
+
+
+def test_telemetry_rejects_unknown_pid_and_routes_by_registry(app_module, client):
+    _consent(client, "classB")
+    r = client.post("/api/telemetry?cohort=classB", json={"participant_id": "made-up", "events": [{"type": "x"}]})
+    assert r.status_code == 404
+
+    pid = _consent(client, "classA")
+    r = client.post("/api/telemetry?cohort=classB", json={"participant_id": pid, "events": [{"type": "page_view"}]})
+    assert r.get_json()["accepted"] == 1
+    admin = app_module.app.test_client()
+    assert any(pid in line for line in _export(admin, "client_events", "classA"))
+    assert not any(pid in line for line in _export(admin, "client_events", "classB"))
+
+
+def test_telemetry_out_of_range_client_ts_is_stored_as_null(app_module, client):
+    pid = _consent(client)
+    events = [{"type": "huge", "t": 1e30}, {"type": "inf", "t": float("inf")}, {"type": "ok", "t": 1700000000000}]
+    r = client.post("/api/telemetry", json={"participant_id": pid, "events": events})
+    assert r.status_code == 200
+    assert r.get_json()["accepted"] == 3
+
+    rows = csv.DictReader(_export(app_module.app.test_client(), "client_events", "default"))
+    got = {r["event_type"]: r["client_ts"] for r in rows if r["participant_id"] == pid}
+    assert got == {"huge": "", "inf": "", "ok": "1700000000000"}
+
+
+def test_t2_eligible_bounds_with_offset_are_converted_to_utc(app_module, client):
+    pid = _consent(client)
+    client.post(f"/t1?pid={pid}", data={})
+    eligible_at = datetime.fromisoformat(app_module.get_t2_eligibility(pid)[1])
+
+    def listed(start, end):
+        r = client.get("/_admin/t2_eligible", query_string={"token": "tok", "from": start, "to": end, "all": "1"})
+        assert r.status_code == 200
+        return pid in {p["participant_id"] for p in r.get_json()["participants"]}
+
+    # 同一个 UTC 区间写成 +08:00
+    local = (eligible_at + timedelta(hours=8)).replace(tzinfo=timezone(timedelta(hours=8)))
+    assert listed((local - timedelta(minutes=1)).isoformat(), (local + timedelta(minutes=1)).isoformat())
+    # 只看字面值的话这个区间会命中，换算成 UTC 之后不应命中
+    naive_local = eligible_at.replace(tzinfo=timezone(timedelta(hours=8)))
+    assert not listed((naive_local - timedelta(minutes=1)).isoformat(), (naive_local + timedelta(minutes=1)).isoformat())
+
+
+@pytest.fixture
+def compact_pid(app_module, client, monkeypatch):
+    # 存储格式只对新建的库生效：compact1 第一次被建时就是 compact
+    monkeypatch.setattr(app_module, "STORAGE_FORMAT", "compact")
+    pid = _consent(client, "compact1")
+    conn = app_module.db_conn("compact1")
+    try:
+        assert conn.storage_format == "compact"
+    finally:
+        conn.close()
+    return pid
+
+
+def test_compact_chat_ts_exports_like_isoformat(app_module, client, compact_pid):
+    times = [
+        datetime(2025, 3, 1, 9, 5, 7),
+        datetime(2025, 3, 1, 23, 59, 59, 999999),
+        datetime(2025, 3, 2, 0, 0, 0, 1200),
+    ]
+    for t in times:
+        app_module.STORAGE.append_chat_turn("compact1", compact_pid, "hi", lambda turn_id: "ok", 20, t)
+
+    rows = [r for r in csv.DictReader(_export(client, "chat_log", "compact1")) if r["participant_id"] == compact_pid]
+    assert [r["ts"] for r in rows] == [t.isoformat() for t in times for _ in ("user", "assistant")]
+
+
+def test_ua_id_cache_survives_rolled_back_material_choice(client, compact_pid):
+    ua = {"User-Agent": f"pytest-{uuid.uuid4()}"}
+    body = {"choice": "a", "label": "b", "page_time": "x", "rt_ms": 5}
+
+    # 外键失败 → 整个写事务回滚，连同这次新插入的 user_agents 行
+    with pytest.raises(sqlite3.IntegrityError):
+        client.post("/api/material_choice?cohort=compact1", json={**body, "participant_id": "no-such-pid"}, headers=ua)
+
+    for _ in range(2):
+        r = client.post("/api/material_choice", json={**body, "participant_id": compact_pid}, headers=ua)
+        assert r.status_code == 200
+    rows = [r for r in csv.DictReader(_export(client, "material_choice", "compact1")) if r["participant_id"] == compact_pid]
+    assert [r["user_agent"] for r in rows] == [ua["User-Agent"]]
+
+
+def test_registered_pid_routes_to_its_own_cohort_not_the_session(app_module, client):
+    pid = _consent(client)
+    # 同一台电脑上下一个参与者进了 classA：session 里的 cohort / participant_id 都换了
+    _consent(client, "classA")
+
+    r = client.post("/api/chat_send", json={"participant_id": pid, "text": "hi"})
+    assert r.status_code == 200
+    admin = app_module.app.test_client()
+    assert any(pid in line for line in _export(admin, "chat_log", "default"))
+    assert not any(pid in line for line in _export(admin, "chat_log", "classA"))
@@ -0,0 +1,93 @@
+import os
+import sqlite3
+from datetime import datetime
+
+import backup
+
+
+def _writer(db_path):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA wal_autocheckpoint = 0;")
+    return conn
+
+
+def _insert(conn, start, n=50):
+    conn.execute("BEGIN;")
+    conn.executemany("INSERT INTO t(x) VALUES (?);", [(i,) for i in range(start, start + n)])
+    conn.execute("COMMIT;")
+
+
+def _restore_count(tmp_path, backup_dir):
+    out = str(tmp_path / "restored.db")
+    backup.restore(backup_dir, "experiment", out)
+    conn = sqlite3.connect(out)
+    try:
+        return conn.execute("SELECT COUNT(*), SUM(x) FROM t;").fetchone()
+    finally:
+        conn.close()
+
+
+def _setup(tmp_path):
+    db_path = str(tmp_path / "experiment.db")
+    backup_dir = str(tmp_path / "backup")
+    w = _writer(db_path)
+    w.execute("CREATE TABLE t (x INTEGER);")
+    rep = backup.Replicator(backup_dir, lambda: [db_path])
+    _insert(w, 0)
+    rep.run_once()
+    return db_path, backup_dir, w, rep
+
+
+def test_single_reset_continues_generation(tmp_path):
+    db_path, backup_dir, w, rep = _setup(tmp_path)
+    gen = rep.states[db_path].generation
+
+    # 复制者上一轮已 checkpoint 完 → 这次写会重置 WAL 一次
+    _insert(w, 50)
+    rep.run_once()
+
+    assert rep.states[db_path].generation == gen
+    assert _restore_count(tmp_path, backup_dir) == w.execute("SELECT COUNT(*), SUM(x) FROM t;").fetchone()
+
+
+def test_double_reset_starts_new_generation(tmp_path):
+    db_path, backup_dir, w, rep = _setup(tmp_path)
+    gen = rep.states[db_path].generation
+
+    # 两轮之间：写（重置一次）→ 别的连接 checkpoint → 再写（又重置一次），第一批帧已不在 WAL 里
+    _insert(w, 50)
+    w.execute("PRAGMA wal_checkpoint(PASSIVE);")
+    _insert(w, 100)
+    rep.run_once()
+
+    assert rep.states[db_path].generation != gen
+    assert [g["reason"] for g in backup.list_generations(backup_dir, "experiment")] == ["start", "wal_reset"]
+    assert _restore_count(tmp_path, backup_dir) == (150, sum(range(150)))
+
+
+def test_first_segment_is_not_capped(tmp_path):
+    # 开新代时 WAL 里已经有很多帧：第一段只复制一部分的话，重放会把快照里的页盖回旧版本
+    db_path = str(tmp_path / "experiment.db")
+    backup_dir = str(tmp_path / "backup")
+    w = _writer(db_path)
+    w.execute("CREATE TABLE t (x INTEGER);")
+    for start in range(0, 4000, 100):
+        _insert(w, start, 100)
+    rep = backup.Replicator(backup_dir, lambda: [db_path], max_frames_per_cycle=20)
+    rep.run_once()
+
+    expected = (4000, sum(range(4000)))
+    assert _restore_count(tmp_path, backup_dir) == expected
+
+    gen = backup.list_generations(backup_dir, "experiment")[-1]
+    first = os.path.join(backup_dir, "experiment", gen["generation"], "wal", gen["segments"][0])
+    meta, frames = backup.read_segment(first)
+    assert len(frames) > 20
+    out = str(tmp_path / "restored_to.db")
+    backup.restore(backup_dir, "experiment", out, to=datetime.fromisoformat(meta["ts"]))
+    conn = sqlite3.connect(out)
+    try:
+        assert conn.execute("SELECT COUNT(*), SUM(x) FROM t;").fetchone() == expected
+    finally:
+        conn.close()